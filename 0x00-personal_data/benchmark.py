@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""benchmark module: compares the redaction paths of filtered_logger
+
+Usage: ./benchmark.py [--size N] [--density D] [--number N] [--seed S]
+                      [--json PATH] [benchmark ...]
+"""
+import argparse
+from functools import partial
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List
+
+from filtered_logger import (
+    FILTERED_FIELDS, PII_FIELDS, RedactingFormatter, RedactingJSONFormatter,
+    export_parallel, filter_batch, filter_data, filter_datum, get_redactor,
+    get_sqlite_pool
+)
+
+
+MESSAGE = ("name=Bob;email=bob@dylan.com;phone=555-0100;ssn=123-45-6789;"
+           "password=bobbycool;ip=127.0.0.1;last_login=2019-11-14;")
+MESSAGES = {
+    "short": "ip=127.0.0.1;name=Bob;",
+    "long": "".join(f"key{i}=value{i};" for i in range(60)) + MESSAGE,
+    "pii-dense": MESSAGE * 10,
+}
+NUMBER = 100000
+EXPORT_ROWS = 200000
+BCRYPT_PASSWORDS = 64
+POOL_QUERIES = 5000
+SAMPLES = 2000
+
+
+def filter_datum_per_call(
+    fields: List[str],
+    redaction: str,
+    message: str,
+    separator: str
+) -> str:
+    """the uncached filter_datum: builds the pattern on every call"""
+    return re.sub(
+        f'({"|".join(fields)})=[^{separator}]+',
+        lambda m: f'{m.group(1)}={redaction}',
+        message
+    )
+
+
+def run(name: str, func: Callable[[], str], number: int = NUMBER) -> float:
+    """times func and prints its throughput, returns the ops/sec"""
+    seconds = timeit.timeit(func, number=number)
+    ops = number / seconds
+    print(f"{name:<24}{ops:>14,.0f} ops/sec")
+    return ops
+
+
+def bench_redaction() -> None:
+    """runs the redaction microbenchmark"""
+    fields = list(PII_FIELDS)
+    per_call = run("re.sub per call", lambda: filter_datum_per_call(
+        fields, "***", MESSAGE, ";"))
+    cached = run("cached Redactor", lambda: filter_datum(
+        fields, "***", MESSAGE, ";"))
+    print(f"speedup: {cached / per_call:.2f}x")
+
+    for kind, message in MESSAGES.items():
+        redactor = get_redactor(fields, ";")
+        run(f"{kind} ({len(message)} chars)",
+            lambda: redactor.redact(message))
+
+
+def bench_export(rows: int = EXPORT_ROWS) -> None:
+    """times export_parallel on an SQLite users table for an
+    increasing number of worker processes"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "users.db")
+        db = sqlite3.connect(db_path)
+        db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, "
+                   "email TEXT, phone TEXT, ssn TEXT, password TEXT, "
+                   "ip TEXT, last_login TEXT)")
+        db.executemany(
+            "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((i, f"user{i}", f"user{i}@example.com", "555-0100",
+              "123-45-6789", "secret", "127.0.0.1", "2019-11-14")
+             for i in range(rows)))
+        db.commit()
+        db.close()
+
+        connect = partial(sqlite3.connect, db_path)
+        out = os.path.join(tmp, "export.txt")
+        print(f"export of {rows:,} rows")
+        workers = 1
+        base = None
+        while workers <= (os.cpu_count() or 1):
+            start = time.perf_counter()
+            export_parallel(out, workers=workers, connect=connect)
+            elapsed = time.perf_counter() - start
+            base = base or elapsed
+            print(f"{workers:>3} workers{rows / elapsed:>14,.0f} rows/sec"
+                  f"  ({base / elapsed:.2f}x)")
+            workers *= 2
+
+
+def bench_formatters(number: int = NUMBER) -> None:
+    """compares CPU time and output size per record of the text and
+    JSON redacting formatters"""
+    for formatter in (RedactingFormatter(PII_FIELDS),
+                      RedactingJSONFormatter(PII_FIELDS)):
+        size = 0
+        start = time.process_time()
+        for _ in range(number):
+            record = logging.LogRecord("user_data", logging.INFO, __file__,
+                                       0, MESSAGE, None, None)
+            size += len(formatter.format(record).encode('utf-8'))
+        cpu = time.process_time() - start
+        print(f"{type(formatter).__name__:<24}"
+              f"{cpu / number * 1e6:>8.2f} us/record"
+              f"{size / number:>8.0f} bytes/record")
+
+
+def bench_bcrypt(count: int = BCRYPT_PASSWORDS) -> None:
+    """times hash_passwords on thread and process pools of an
+    increasing size against sequential hashing"""
+    from encrypt_password import hash_password, hash_passwords, make_executor
+
+    passwords = [f"password{i}" for i in range(count)]
+    start = time.perf_counter()
+    for password in passwords:
+        hash_password(password)
+    base = count / (time.perf_counter() - start)
+    print(f"{'sequential':<20}{base:>10,.1f} hashes/sec")
+
+    for processes in (False, True):
+        workers = 1
+        while workers <= (os.cpu_count() or 1):
+            with make_executor(workers, processes) as executor:
+                start = time.perf_counter()
+                hash_passwords(passwords, executor)
+                rate = count / (time.perf_counter() - start)
+            kind = "processes" if processes else "threads"
+            print(f"{workers:>3} {kind:<16}{rate:>10,.1f} hashes/sec"
+                  f"  ({rate / base:.2f}x)")
+            workers *= 2
+
+
+def bench_pool(queries: int = POOL_QUERIES) -> None:
+    """times queries on a connection opened per query and on the
+    SQLite stand-in of the connection pool, checking on the way that a
+    released connection comes back without the borrower's transaction"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "users.db")
+        pool = get_sqlite_pool(db_path, size=1)
+        with pool.connection() as db:
+            db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY)")
+            db.commit()
+        with pool.connection() as db:
+            db.execute("INSERT INTO users VALUES (1)")
+        with pool.connection() as db:
+            assert not db.in_transaction
+            assert db.execute("SELECT COUNT(*) FROM users").fetchone() == (0,)
+
+        start = time.perf_counter()
+        for _ in range(queries):
+            db = sqlite3.connect(db_path)
+            db.execute("SELECT COUNT(*) FROM users").fetchone()
+            db.close()
+        base = queries / (time.perf_counter() - start)
+        print(f"{'connect per query':<20}{base:>12,.0f} queries/sec")
+
+        start = time.perf_counter()
+        for _ in range(queries):
+            with pool.connection() as db:
+                db.execute("SELECT COUNT(*) FROM users").fetchone()
+        rate = queries / (time.perf_counter() - start)
+        print(f"{'pooled':<20}{rate:>12,.0f} queries/sec"
+              f"  ({rate / base:.2f}x)")
+        pool.close()
+
+
+def synthetic_fields(size: int, density: float,
+                     rng: random.Random) -> List[tuple]:
+    """returns size (key, value) pairs of which about density are
+    PII fields"""
+    pairs = []
+    for i in range(size):
+        if rng.random() < density:
+            key = rng.choice(PII_FIELDS)
+        else:
+            key = f"field{i}"
+        value = "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789",
+                                    k=rng.randint(4, 24)))
+        pairs.append((key, value))
+    return pairs
+
+
+def synthetic_messages(count: int, size: int, density: float,
+                       rng: random.Random) -> List[str]:
+    """returns count key=value; log messages"""
+    return ["".join(f"{key}={value};" for key, value
+                    in synthetic_fields(size, density, rng))
+            for _ in range(count)]
+
+
+def synthetic_rows(count: int, size: int, density: float,
+                   rng: random.Random) -> List[dict]:
+    """returns count user rows with size columns, the same columns for
+    every row as a query would"""
+    columns = [key for key, _ in synthetic_fields(size, density, rng)]
+    columns = list(dict.fromkeys(columns))
+    return [{column: value for column, (_, value) in
+             zip(columns, synthetic_fields(len(columns), 0, rng))}
+            for _ in range(count)]
+
+
+def measure(name: str, func: Callable, inputs: list,
+            number: int) -> Dict[str, float]:
+    """calls func on the inputs, cycling through them, number times and
+    returns ops/sec, p50/p99 latency and the peak traced allocation"""
+    timer = time.perf_counter_ns
+    latencies = []
+    count = len(inputs)
+    start = timer()
+    for i in range(number):
+        item = inputs[i % count]
+        before = timer()
+        func(item)
+        latencies.append(timer() - before)
+    elapsed = (timer() - start) / 1e9
+
+    tracemalloc.start()
+    for i in range(min(count, SAMPLES)):
+        func(inputs[i])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "name": name,
+        "ops_per_sec": number / elapsed,
+        "p50_us": quantiles[49] / 1e3,
+        "p99_us": quantiles[98] / 1e3,
+        "peak_alloc_bytes": peak,
+    }
+
+
+def bench_paths(size: int = 8, density: float = 0.5, number: int = NUMBER,
+                seed: int = 0) -> List[Dict[str, float]]:
+    """times every redaction path on synthetic records and rows of size
+    fields with a density share of PII, prints and returns the results"""
+    rng = random.Random(seed)
+    messages = synthetic_messages(SAMPLES, size, density, rng)
+    rows = synthetic_rows(SAMPLES, size, density, rng)
+    columns = list(rows[0])
+    tuples = [tuple(row.values()) for row in rows]
+    fields = list(PII_FIELDS)
+    text = RedactingFormatter(fields)
+    structured = RedactingJSONFormatter(fields)
+
+    def record(message: str) -> logging.LogRecord:
+        """builds the log record of a message"""
+        return logging.LogRecord("user_data", logging.INFO, __file__, 0,
+                                 message, None, None)
+
+    paths = [
+        ("re.sub per call", lambda m: filter_datum_per_call(
+            fields, "***", m, ";"), messages),
+        ("filter_datum", lambda m: filter_datum(fields, "***", m, ";"),
+         messages),
+        ("RedactingFormatter", lambda m: text.format(record(m)), messages),
+        ("RedactingJSONFormatter", lambda m: structured.format(record(m)),
+         messages),
+        ("filter_data", filter_data, rows),
+        ("filter_batch (1 row)", lambda t: filter_batch(columns, (t,)),
+         tuples),
+    ]
+    print(f"{size} fields, {density:.0%} PII, {number:,} ops, "
+          f"{len(FILTERED_FIELDS)} filtered fields")
+    print(f"{'path':<24}{'ops/sec':>12}{'p50 us':>9}{'p99 us':>9}"
+          f"{'peak B':>10}")
+    results = []
+    for name, func, inputs in paths:
+        result = measure(name, func, inputs, number)
+        print(f"{name:<24}{result['ops_per_sec']:>12,.0f}"
+              f"{result['p50_us']:>9.2f}{result['p99_us']:>9.2f}"
+              f"{result['peak_alloc_bytes']:>10,}")
+        results.append(result)
+    return results
+
+
+BENCHMARKS = {
+    "paths": bench_paths,
+    "redaction": bench_redaction,
+    "formatters": bench_formatters,
+    "export": bench_export,
+    "bcrypt": bench_bcrypt,
+    "pool": bench_pool,
+}
+
+
+def main() -> None:
+    """runs the benchmarks named on the command line, the redaction
+    paths suite by default"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="one of {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--size", type=int, default=8,
+                        help="fields per synthetic record")
+    parser.add_argument("--density", type=float, default=0.5,
+                        help="share of PII fields in a record")
+    parser.add_argument("--number", type=int, default=NUMBER,
+                        help="operations per path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the paths results as JSON to PATH")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    for name in args.benchmarks or ["paths"]:
+        if name != "paths":
+            BENCHMARKS[name]()
+            continue
+        results = bench_paths(args.size, args.density, args.number,
+                              args.seed)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({
+                    "size": args.size,
+                    "density": args.density,
+                    "number": args.number,
+                    "seed": args.seed,
+                    "results": results,
+                }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,190 @@
 #!/usr/bin/env python3
 """encrypt_password module"""
+import asyncio
+from concurrent.futures import (
+    Executor, ProcessPoolExecutor, ThreadPoolExecutor
+)
+from functools import lru_cache, partial
+import os
+import time
+from typing import Iterable, List, Optional, Tuple, Union
+
 import bcrypt
 
 
-def hash_password(password: str) -> bytes:
+MIN_ROUNDS = 12
+MAX_ROUNDS = 16
+PROBE_ROUNDS = 8
+TARGET_MS = 250.0
+
+
+def calibrate(
+    target_ms: float = TARGET_MS,
+    min_rounds: int = MIN_ROUNDS,
+    max_rounds: int = MAX_ROUNDS
+) -> int:
+    """
+    Return the highest bcrypt cost whose hash time stays within
+    target_ms on this machine, never below min_rounds (bcrypt's
+    default of 12) however slow the machine is. Each extra round
+    doubles the work, so one timed hash at a low cost is enough to
+    extrapolate.
+    """
+    salt = bcrypt.gensalt(rounds=PROBE_ROUNDS)
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", salt)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    rounds = PROBE_ROUNDS
+    while rounds < max_rounds and elapsed_ms * 2 <= target_ms:
+        rounds += 1
+        elapsed_ms *= 2
+    return max(min_rounds, min(rounds, max_rounds))
+
+
+@lru_cache(maxsize=None)
+def get_cost() -> int:
+    """
+    Return the bcrypt cost used for new hashes: BCRYPT_ROUNDS when set,
+    otherwise calibrated against BCRYPT_TARGET_MS (250 by default).
+    With BCRYPT_COST_FILE set, the calibrated cost is kept in that file
+    and read back by every later process, so all workers share one
+    cost instead of each measuring its own.
+    """
+    rounds = os.getenv('BCRYPT_ROUNDS')
+    if rounds:
+        return int(rounds)
+    cost_file = os.getenv('BCRYPT_COST_FILE')
+    if cost_file:
+        try:
+            with open(cost_file) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            pass
+    rounds = calibrate(float(os.getenv('BCRYPT_TARGET_MS') or TARGET_MS))
+    if cost_file:
+        tmp_path = f"{cost_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(rounds))
+        os.replace(tmp_path, cost_file)
+    return rounds
+
+
+def hash_cost(hashed_password: bytes) -> int:
+    """
+    Return the cost factor stored in a bcrypt hash.
+    """
+    return int(hashed_password.split(b'$')[2])
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Return True if the hash was made with a lower cost than the
+    current one; stronger hashes are left as they are.
+    """
+    return hash_cost(hashed_password) < get_cost()
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> bytes:
     """
     Hash a password using bcrypt, returns the
-    hashed password as a byte string.
+    hashed password as a byte string. rounds defaults to get_cost().
     """
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=rounds or get_cost())
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed_password
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
+def is_valid(
+    hashed_password: bytes,
+    password: str,
+    check_cost: bool = False
+) -> Union[bool, Tuple[bool, bool]]:
     """
     Validate that the provided password matches the hashed password.
+    With check_cost, return (valid, needs_rehash) so callers can store
+    a new hash_password() after a successful login.
+    """
+    valid = bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+    if check_cost:
+        return valid, valid and needs_rehash(hashed_password)
+    return valid
+
+
+def make_executor(
+    workers: Optional[int] = None,
+    processes: bool = False
+) -> Executor:
+    """
+    Build a pool of workers for bcrypt. Threads are enough since
+    bcrypt releases the GIL while hashing.
+    """
+    if processes:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers,
+                              thread_name_prefix="bcrypt")
+
+
+@lru_cache(maxsize=None)
+def get_executor() -> Executor:
+    """
+    Return the shared bcrypt pool, sized by BCRYPT_WORKERS (the number
+    of CPUs by default) and made of processes when BCRYPT_POOL is
+    "process".
+    """
+    workers = int(os.getenv('BCRYPT_WORKERS') or os.cpu_count() or 1)
+    processes = os.getenv('BCRYPT_POOL') == 'process'
+    return make_executor(workers, processes)
+
+
+async def hash_password_async(
+    password: str,
+    executor: Optional[Executor] = None
+) -> bytes:
+    """
+    Hash a password on the bcrypt pool without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or get_executor(), hash_password, password, get_cost())
+
+
+async def is_valid_async(
+    hashed_password: bytes,
+    password: str,
+    executor: Optional[Executor] = None
+) -> bool:
+    """
+    Validate a password on the bcrypt pool without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or get_executor(), is_valid, hashed_password, password)
+
+
+def hash_passwords(
+    passwords: Iterable[str],
+    executor: Optional[Executor] = None
+) -> List[bytes]:
+    """
+    Hash a batch of passwords in parallel, in order. The cost is the
+    one of this process, so pool processes do not calibrate their own.
+    """
+    return list((executor or get_executor()).map(
+        partial(hash_password, rounds=get_cost()), passwords))
+
+
+def validate_passwords(
+    pairs: Iterable[Tuple[bytes, str]],
+    executor: Optional[Executor] = None
+) -> List[bool]:
+    """
+    Validate a batch of (hashed_password, password) pairs in parallel,
+    in order.
     """
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+    pairs = list(pairs)
+    if not pairs:
+        return []
+    hashed_passwords, passwords = zip(*pairs)
+    return list((executor or get_executor()).map(
+        is_valid, hashed_passwords, passwords))
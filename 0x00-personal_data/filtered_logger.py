@@ -1,12 +1,33 @@
 #!/usr/bin/env python3
 """filtered_logger module"""
+import atexit
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
 import mysql.connector
 from mysql.connector import connection
 import os
+import queue
 import re
-from typing import List
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import (
+    Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence,
+    TextIO, Tuple
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logging.basicConfig(
@@ -18,6 +39,37 @@ PII_FIELDS = ("name", "email", "phone", "ssn", "password")
 FILTERED_FIELDS = ["name", "email", "phone", "ssn", "password"]
 
 
+REDACTOR_CACHE_SIZE = 128
+
+
+class Redactor:
+    """Redaction engine compiled once for a set of fields and a separator"""
+
+    def __init__(self, fields: Tuple[str, ...], separator: str):
+        self.fields = fields
+        self.separator = separator
+        self.pattern = re.compile('((?:{})=)[^{}]+'.format(
+            '|'.join(re.escape(field) for field in fields),
+            re.escape(separator)
+        ))
+
+    def redact(self, message: str, redaction: str = "***") -> str:
+        """returns the message with the value of every field replaced"""
+        return self.pattern.sub(lambda m: m[1] + redaction, message)
+
+
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def _get_redactor(fields: Tuple[str, ...], separator: str) -> Redactor:
+    """builds the Redactor for a hashable fields tuple"""
+    return Redactor(fields, separator)
+
+
+def get_redactor(fields: List[str], separator: str) -> Redactor:
+    """returns the cached Redactor for the fields and separator,
+    evicting the least recently used one once the cache is full"""
+    return _get_redactor(tuple(fields), separator)
+
+
 def filter_datum(
     fields: List[str],
     redaction: str,
@@ -25,11 +77,7 @@ def filter_datum(
     separator: str
 ) -> str:
     """returns the log message obfuscated"""
-    return re.sub(
-        f'({"|".join(fields)})=[^{separator}]+',
-        lambda m: f'{m.group(1)}={redaction}',
-        message
-    )
+    return get_redactor(fields, separator).redact(message, redaction)
 
 
 class RedactingFormatter(logging.Formatter):
@@ -41,48 +89,350 @@ class RedactingFormatter(logging.Formatter):
     def __init__(self, fields: List[str]):
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.redactor = get_redactor(fields, self.SEPARATOR)
 
     def format(self, record: logging.LogRecord) -> str:
         """formats the logger"""
-        record.msg = filter_datum(
-            self.fields,
-            self.REDACTION,
-            record.msg,
-            self.SEPARATOR
-        )
+        record.msg = self.redactor.redact(record.msg, self.REDACTION)
         return super().format(record)
 
 
-def get_logger() -> logging.Logger:
-    """Creates and returns a logger named 'user_data'."""
-    logger = logging.getLogger("user_data")
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
+def _json_dumps(data: dict) -> str:
+    """serializes data with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, default=str).decode('utf-8')
+    return json.dumps(data, default=str, separators=(',', ':'))
+
+
+class RedactingJSONFormatter(logging.Formatter):
+    """ Formatter writing each record as one JSON object whose
+    "fields" are the key=value pairs of the message (or the message
+    itself when it is a dict) with the PII fields redacted, and whose
+    "message" is the rest of the text, when there is any
+
+    A key is the last word before the "=" and is redacted when it ends
+    with a PII field, as RedactingFormatter does; the words before it
+    go to "message". A segment that is not a single key=value pair goes
+    to "message" through the same Redactor as RedactingFormatter. """
+    REDACTION = "***"
+    SEPARATOR = ";"
+
+    def __init__(self, fields: List[str]):
+        super(RedactingJSONFormatter, self).__init__()
+        self.fields = fields
+        self.suffixes = tuple(fields)
+        self.redactor = get_redactor(fields, self.SEPARATOR)
+
+    def is_pii(self, key: Any) -> bool:
+        """returns True if the value of key must be redacted"""
+        return isinstance(key, str) and key.endswith(self.suffixes)
+
+    def redact_value(self, value: Any) -> Any:
+        """returns value with the PII keys of the dicts it holds, at
+        any depth, redacted"""
+        if isinstance(value, dict):
+            return {
+                key: self.REDACTION if self.is_pii(key)
+                else self.redact_value(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, (list, tuple)):
+            return [self.redact_value(item) for item in value]
+        return value
+
+    def split_message(self, record: logging.LogRecord) -> Tuple[dict, str]:
+        """returns the fields of the record message, redacted, and the
+        parts of its text that are not key=value pairs"""
+        if isinstance(record.msg, dict):
+            return self.redact_value(record.msg), ""
+        fields = {}
+        text = []
+        for part in record.getMessage().split(self.SEPARATOR):
+            words, sep, value = part.partition('=')
+            words = words.rsplit(None, 1)
+            if sep and words and '=' not in value:
+                key = words[-1]
+                fields[key] = self.REDACTION if self.is_pii(key) else value
+                if len(words) > 1:
+                    text.append(words[0].strip())
+            elif sep:
+                redacted = self.redactor.redact(part, self.REDACTION)
+                text.append(redacted.strip())
+            elif part.strip():
+                text.append(part.strip())
+        return fields, self.SEPARATOR.join(text)
+
+    def redact_fields(self, record: logging.LogRecord) -> dict:
+        """returns the fields of the record message, redacted"""
+        return self.split_message(record)[0]
+
+    def format(self, record: logging.LogRecord) -> str:
+        """formats the record as a JSON object"""
+        fields, message = self.split_message(record)
+        data = {
+            "name": record.name,
+            "level": record.levelname,
+            "asctime": self.formatTime(record),
+            "fields": fields,
+        }
+        if message:
+            data["message"] = message
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return _json_dumps(data)
+
+
+class RedactingQueueHandler(QueueHandler):
+    """ QueueHandler that hands records to a bounded queue and lets a
+    QueueListener thread do the redaction and the writes """
+    OVERFLOW_POLICIES = ("block", "drop")
+
+    def __init__(self, handler: logging.Handler,
+                 queue_size: int = 10000, overflow: str = "block"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.overflow = overflow
+        self.dropped = 0
+        self.listener = RedactingQueueListener(
+            self.queue, handler, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """puts the record on the queue, blocking or dropping it
+        when the queue is full depending on the overflow policy"""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        """stops the listener once every queued record is written"""
+        atexit.unregister(self.close)
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+class RedactingQueueListener(QueueListener):
+    """ QueueListener whose shutdown waits for room in a full queue """
+
+    def enqueue_sentinel(self) -> None:
+        """puts the stop sentinel behind the pending records"""
+        self.queue.put(self._sentinel)
+
+
+_LOGGERS_LOCK = threading.Lock()
+_LOGGER_CONFIGS: Dict[str, tuple] = {}
+_LOGGER_HANDLERS: Dict[str, logging.Handler] = {}
+
+
+def get_logger(
+    name: str = "user_data",
+    fields: List[str] = PII_FIELDS,
+    stream: Optional[TextIO] = None,
+    asynchronous: bool = False,
+    queue_size: int = 10000,
+    overflow: str = "block"
+) -> logging.Logger:
+    """Creates and returns a logger named 'user_data'.
+
+    The logger is configured once per combination of arguments and the
+    same instance is returned on later calls; asking for another
+    configuration of the same name replaces the handler instead of
+    stacking a new one.
+
+    With asynchronous set, records go through a queue of queue_size
+    records and are redacted and written by a background thread; the
+    overflow policy ("block" or "drop") decides what happens when
+    that queue is full. Pending records are flushed at exit.
+    """
+    config = (tuple(fields), stream, asynchronous, queue_size, overflow)
+    logger = logging.getLogger(name)
+    with _LOGGERS_LOCK:
+        if _LOGGER_CONFIGS.get(name) == config:
+            return logger
+
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+        """Create a StreamHandler and set the RedactingFormatter"""
+        stream_handler = logging.StreamHandler(stream)
+        formatter = RedactingFormatter(fields=fields)
+        stream_handler.setFormatter(formatter)
 
-    """Create a StreamHandler and set the RedactingFormatter"""
-    stream_handler = logging.StreamHandler()
-    formatter = RedactingFormatter(fields=PII_FIELDS)
-    stream_handler.setFormatter(formatter)
+        handler = stream_handler
+        if asynchronous:
+            handler = RedactingQueueHandler(
+                stream_handler, queue_size, overflow)
 
-    """Add the handler to the logger"""
-    logger.addHandler(stream_handler)
+        """Replace the handler of a previous configuration"""
+        previous = _LOGGER_HANDLERS.pop(name, None)
+        if previous is not None:
+            logger.removeHandler(previous)
+            previous.close()
+        logger.addHandler(handler)
+        _LOGGER_HANDLERS[name] = handler
+        _LOGGER_CONFIGS[name] = config
 
     return logger
 
 
+def handler_count(name: str = "user_data") -> int:
+    """Returns the number of handlers attached to the named logger."""
+    return len(logging.getLogger(name).handlers)
+
+
+def _db_config() -> dict:
+    """Returns the connection settings read from the environment."""
+    return {
+        'user': os.getenv('PERSONAL_DATA_DB_USERNAME') or 'root',
+        'password': os.getenv('PERSONAL_DATA_DB_PASSWORD') or '',
+        'host': os.getenv('PERSONAL_DATA_DB_HOST') or 'localhost',
+        'database': os.getenv('PERSONAL_DATA_DB_NAME'),
+    }
+
+
 def get_db() -> connection.MySQLConnection:
     """Returns a MySQL database connection."""
-    username = os.getenv('PERSONAL_DATA_DB_USERNAME') or 'root'
-    password = os.getenv('PERSONAL_DATA_DB_PASSWORD') or ''
-    host = os.getenv('PERSONAL_DATA_DB_HOST') or 'localhost'
-    database = os.getenv('PERSONAL_DATA_DB_NAME')
+    return mysql.connector.connect(**_db_config())
+
+
+class ConnectionPool:
+    """ Fixed size pool of database connections
+
+    Connections are opened lazily with connect() up to size, handed out
+    by acquire() after a health check and given back with release() or
+    by leaving the connection() context manager. A released connection
+    is rolled back first, so the next borrower never inherits an open
+    transaction.
+    """
+
+    def __init__(self, connect: Callable[[], Any], size: int = 5,
+                 timeout: Optional[float] = None):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._lent = set()
+
+    @staticmethod
+    def is_healthy(conn: Any) -> bool:
+        """Returns True if the connection still answers a query."""
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def _discard(self, conn: Any) -> None:
+        """Closes a connection and frees its slot in the pool."""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._opened -= 1
 
-    return mysql.connector.connect(
-        user=username,
-        password=password,
-        host=host,
-        database=database
-    )
+    def acquire(self) -> Any:
+        """Returns a healthy connection, opening a new one if the pool
+        is not full and waiting for a released one otherwise."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_open = self._opened < self.size
+                    if can_open:
+                        self._opened += 1
+                if can_open:
+                    try:
+                        return self._lend(self.connect())
+                    except Exception:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("No connection available in pool")
+            if self.is_healthy(conn):
+                return self._lend(conn)
+            self._discard(conn)
+
+    def _lend(self, conn: Any) -> Any:
+        """Records a connection as lent out and returns it."""
+        with self._lock:
+            self._lent.add(id(conn))
+        return conn
+
+    def release(self, conn: Any) -> None:
+        """Gives a connection back to the pool after rolling back what
+        the borrower left uncommitted; a connection that cannot be
+        rolled back is closed instead. Raises ValueError for a
+        connection that is not lent by this pool."""
+        with self._lock:
+            if id(conn) not in self._lent:
+                raise ValueError("Connection is not lent by this pool")
+            self._lent.discard(id(conn))
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """Context manager lending a connection for the block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
+@lru_cache(maxsize=None)
+def get_db_pool() -> ConnectionPool:
+    """Returns the process wide MySQL connection pool, sized by
+    PERSONAL_DATA_DB_POOL_SIZE (5 by default)."""
+    config = _db_config()
+    size = int(os.getenv('PERSONAL_DATA_DB_POOL_SIZE') or 5)
+    return ConnectionPool(lambda: mysql.connector.connect(**config), size)
+
+
+def get_sqlite_pool(path: str, size: int = 5) -> ConnectionPool:
+    """Returns a pool of SQLite connections to the database file at
+    path, standing in for MySQL where no server is available. Every
+    connection must see the same database, so ":memory:", which gives
+    each connection an empty database of its own, is refused."""
+    if not path or path == ":memory:":
+        raise ValueError("SQLite pool needs a database file path")
+    return ConnectionPool(
+        lambda: sqlite3.connect(path, check_same_thread=False), size)
 
 
 def filter_data(data: dict) -> dict:
@@ -92,20 +442,159 @@ def filter_data(data: dict) -> dict:
         value in data.items()}
 
 
-def main() -> None:
+@lru_cache(maxsize=REDACTOR_CACHE_SIZE)
+def row_formatter(columns: Tuple[str, ...]) -> Callable[[tuple], str]:
+    """Returns a function turning a row tuple with these columns into a
+    filtered "key=value; ..." line. The redaction mask is applied once
+    to a template, so a row only costs one format call."""
+    template = []
+    kept = []
+    for i, column in enumerate(columns):
+        key = column.replace('{', '{{').replace('}', '}}')
+        if column in FILTERED_FIELDS:
+            template.append(f"{key}=***")
+        else:
+            template.append(f"{key}={{}}")
+            kept.append(i)
+    template = "; ".join(template)
+
+    if not kept:
+        return lambda row: template.format()
+    if len(kept) == 1:
+        index = kept[0]
+        return lambda row: template.format(row[index])
+    getter = itemgetter(*kept)
+    return lambda row: template.format(*getter(row))
+
+
+def filter_batch(columns: Sequence[str], rows: Iterable[tuple]) -> List[str]:
+    """Returns the filtered log line of every row of a batch of tuples
+    sharing the same columns."""
+    return list(map(row_formatter(tuple(columns)), rows))
+
+
+def fetch_batches(cursor, batch_size: int) -> Iterator[list]:
+    """Yields the rows of an executed query in lists of at most
+    batch_size rows."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def cursor_columns(cursor) -> Tuple[str, ...]:
+    """Returns the column names of an executed query."""
+    return tuple(column[0] for column in cursor.description)
+
+
+def _export_partition(
+    connect: Callable[[], Any],
+    key: str,
+    low: int,
+    high: int,
+    batch_size: int,
+    path: str
+) -> int:
+    """Writes to path the filtered lines of the users whose key is in
+    [low, high), read on a connection of its own, batch_size rows at a
+    time. Returns the number of rows written."""
+    db = connect()
+    cursor = db.cursor()
+    cursor.execute(f"SELECT * FROM users WHERE {key} >= {low} "
+                   f"AND {key} < {high} ORDER BY {key};")
+    columns = cursor_columns(cursor)
+    count = 0
+    with open(path, 'w') as f:
+        for rows in fetch_batches(cursor, batch_size):
+            f.write("\n".join(filter_batch(columns, rows)) + "\n")
+            count += len(rows)
+    cursor.close()
+    db.close()
+    return count
+
+
+def export_parallel(
+    path: str,
+    workers: Optional[int] = None,
+    key: str = "id",
+    ordered: bool = True,
+    batch_size: int = 1000,
+    connect: Callable[[], Any] = get_db
+) -> int:
+    """Writes the filtered users to path using a pool of processes.
+
+    The table is split into key ranges, four per worker, each fetched
+    and filtered by a worker (PERSONAL_DATA_EXPORT_WORKERS, the number
+    of CPUs by default) into a temporary file next to path; the files
+    are then appended to path, in key order or, with ordered unset, as
+    soon as they are done. Memory use does not grow with the table.
+    connect must be picklable. Returns the number of rows written.
+    """
+    if not key.isidentifier():
+        raise ValueError(f"Invalid key column: {key}")
+    if workers is None:
+        workers = int(os.getenv('PERSONAL_DATA_EXPORT_WORKERS') or
+                      os.cpu_count() or 1)
+
+    db = connect()
+    cursor = db.cursor()
+    cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM users;")
+    low, high = cursor.fetchone()
+    cursor.close()
+    db.close()
+    if low is None:
+        return 0
+
+    low, high = int(low), int(high) + 1
+    step = max(1, -(-(high - low) // (workers * 4)))
+    bounds = range(low, high, step)
+
+    count = 0
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(path))) as tmp, \
+            ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(path, 'w') as f:
+        futures = {
+            pool.submit(_export_partition, connect, key,
+                        start, min(start + step, high), batch_size,
+                        os.path.join(tmp, f"{i}.part")): i
+            for i, start in enumerate(bounds)
+        }
+        for future in (futures if ordered else as_completed(futures)):
+            count += future.result()
+            part = os.path.join(tmp, f"{futures[future]}.part")
+            with open(part) as partition:
+                shutil.copyfileobj(partition, f)
+            os.remove(part)
+    return count
+
+
+def main(batch_size: Optional[int] = None) -> None:
     """Main function that retrieves and displays users'
-    data in a filtered format."""
+    data in a filtered format.
+
+    Rows are streamed from an unbuffered cursor batch_size at a time
+    (PERSONAL_DATA_BATCH_SIZE, 1000 by default) so memory use does
+    not grow with the size of the table."""
+    if batch_size is None:
+        batch_size = int(os.getenv('PERSONAL_DATA_BATCH_SIZE') or 1000)
     db = get_db()
-    cursor = db.cursor(dictionary=True)
+    cursor = db.cursor(buffered=False)
 
+    start = time.perf_counter()
     cursor.execute("SELECT * FROM users;")
-    rows = cursor.fetchall()
+    columns = cursor_columns(cursor)
+
+    count = 0
+    for rows in fetch_batches(cursor, batch_size):
+        for log_msg in filter_batch(columns, rows):
+            logging.info(log_msg)
+        count += len(rows)
 
-    for row in rows:
-        filtered_row = filter_data(row)
-        log_msg = "; ".join(
-            [f"{key}={value}" for key, value in filtered_row.items()])
-        logging.info(log_msg)
+    elapsed = time.perf_counter() - start
+    logging.info(f"{count} rows in {elapsed:.2f}s "
+                 f"({count / elapsed if elapsed else 0:.0f} rows/sec)")
 
     cursor.close()
     db.close()
@@ -70,12 +70,10 @@ class BasicAuth(Auth):
         if user_pwd is None or not isinstance(user_pwd, str):
             return None
 
-        user_list = User.search({'email': user_email})
-        if not user_list:
+        user = User.first({'email': user_email})
+        if user is None:
             return None
 
-        user = user_list[0]
-
         if not user.is_valid_password(user_pwd):
             return None
 
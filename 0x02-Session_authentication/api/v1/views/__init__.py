@@ -8,4 +8,4 @@ app_views = Blueprint("app_views", __name__, url_prefix="/api/v1")
 from api.v1.views.index import *
 from api.v1.views.users import *
 
-User.load_from_file()
+User.load()
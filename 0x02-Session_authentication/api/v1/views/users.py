@@ -2,18 +2,66 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request, stream_with_context
+from typing import Iterator
+import json
 from models.user import User
 
 
+PER_PAGE = 100
+
+
+def paged_users() -> Iterator[User]:
+    """ Iterate over the users selected by the page, per_page and
+    after_id query parameters; raise ValueError when they are invalid
+    and KeyError when there is no user of ID after_id
+    """
+    page = request.args.get('page')
+    per_page = request.args.get('per_page')
+    after_id = request.args.get('after_id')
+
+    if page is None and per_page is None:
+        return User.iter_all(after=after_id)
+
+    page = int(page) if page is not None else 1
+    per_page = int(per_page) if per_page is not None else PER_PAGE
+    if page < 1 or per_page < 1:
+        raise ValueError("page and per_page must be positive")
+    return User.iter_all((page - 1) * per_page, per_page, after=after_id)
+
+
+def stream_users(users: Iterator[User]) -> Iterator[str]:
+    """ Yield the JSON array of the users one element at a time
+    """
+    yield "["
+    for i, user in enumerate(users):
+        yield ("," if i else "") + json.dumps(user.to_json())
+    yield "]\n"
+
+
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters (all optional):
+      - page, per_page: only the given page (per_page defaults to 100)
+      - after_id: only the users after this User ID
+      - stream: when "true", the JSON array is streamed
     Return:
-      - list of all User objects JSON represented
+      - list of User objects JSON represented
+      - 400 if page or per_page is not a positive integer
+      - 400 if there is no User of ID after_id
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    try:
+        users = paged_users()
+    except ValueError:
+        return jsonify({'error': "page and per_page must be positive "
+                                 "integers"}), 400
+    except KeyError:
+        return jsonify({'error': "after_id not found"}), 400
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return Response(stream_with_context(stream_users(users)),
+                        mimetype='application/json')
+    return jsonify([user.to_json() for user in users])
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -22,13 +70,13 @@ def view_one_user(user_id: str = None) -> str:
     Path parameter:
       - User ID
     Return:
-      - User object JSON represented
+      - User object JSON represented, the authenticated one for "me"
       - 404 if the User ID doesn't exist
     """
-    if user_id = 'me':
-	    if request.current_user is None:
+    if user_id == 'me':
+        if request.current_user is None:
             abort(404)
-        return jsonify(request.current_user.to_dict())
+        return jsonify(request.current_user.to_json())
     if user_id is None:
         abort(404)
     user = User.get(user_id)
@@ -122,5 +170,8 @@ def update_user(user_id: str = None) -> str:
         user.first_name = rj.get('first_name')
     if rj.get('last_name') is not None:
         user.last_name = rj.get('last_name')
-    user.save()
+    try:
+        user.save()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify(user.to_json()), 200
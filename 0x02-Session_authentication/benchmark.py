@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+""" Benchmarks of the file backed models
+
+Usage: ./benchmark.py [--users N [N ...]] [benchmark ...]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, List
+
+from models.base import DATA, TIMESTAMP_FORMAT, Base, ObjectStore
+from models.storage import SQLiteStorage
+from models.serializers import SERIALIZERS
+from models.user import User
+
+
+USERS = [1000, 100000]
+LOOKUPS = 1000
+SCANS = 10
+THREADS = [1, 2, 4, 8]
+OPERATIONS = 2000
+PER_OBJECT_SAVES = 2000
+SAVES = 200
+FOREIGN_SAVES = 100
+
+
+def populate(count: int) -> List[User]:
+    """ Fill DATA with count unsaved users, bypassing the file store
+    """
+    DATA['User'] = ObjectStore()
+    users = []
+    for i in range(count):
+        user = User(email="user{}@example.com".format(i),
+                    first_name="First{}".format(i),
+                    last_name="Last{}".format(i))
+        DATA['User'][user.id] = user
+        users.append(user)
+    User.rebuild_indexes()
+    return users
+
+
+def scan_search(attributes: dict) -> List[User]:
+    """ The search without indexes: a scan of every object
+    """
+    def _search(obj):
+        for k, v in attributes.items():
+            if (getattr(obj, k) != v):
+                return False
+        return True
+    return list(filter(_search, DATA['User'].values()))
+
+
+def timed(func: Callable, args: list) -> float:
+    """ Return the mean latency of func over args, in microseconds
+    """
+    start = time.perf_counter()
+    for arg in args:
+        func(arg)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def bench_search(users: List[int]):
+    """ Email lookup latency through the index and through a scan
+    """
+    print("{:>10}{:>14}{:>14}".format("users", "index us", "scan us"))
+    for count in users:
+        populate(count)
+        step = max(1, count // LOOKUPS)
+        queries = [{'email': "user{}@example.com".format(i)}
+                   for i in range(0, count, step)][:LOOKUPS]
+        indexed = timed(User.search, queries)
+        scan = timed(scan_search, queries[:SCANS])
+        print("{:>10,}{:>14.2f}{:>14.2f}".format(count, indexed, scan))
+
+
+def bench_serializers(users: List[int]):
+    """ Save time, load time and file size of each snapshot format
+    """
+    print("{:>10}{:>8}{:>10}{:>10}{:>12}".format(
+        "users", "format", "save s", "load s", "size KiB"))
+    cwd = os.getcwd()
+    serializer = User.serializer
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                populate(count)
+                objs = DATA['User']
+                for extension in SERIALIZERS:
+                    User.serializer = SERIALIZERS[extension]
+                    DATA['User'] = objs
+                    start = time.perf_counter()
+                    User.save_to_file()
+                    saved = time.perf_counter() - start
+                    start = time.perf_counter()
+                    User.load_from_file()
+                    loaded = time.perf_counter() - start
+                    size = os.path.getsize(".db_User.{}".format(extension))
+                    print("{:>10,}{:>8}{:>10.3f}{:>10.3f}{:>12,.0f}".format(
+                        count, extension, saved, loaded, size / 1024))
+        finally:
+            os.chdir(cwd)
+            User.serializer = serializer
+
+
+def bench_startup(users: List[int]):
+    """ Time to load the store, eagerly and lazily, and of the first
+    get after a lazy load
+    """
+    print("{:>10}{:>12}{:>12}{:>12}{:>14}".format(
+        "users", "json s", "bin s", "lazy s", "first get us"))
+    cwd = os.getcwd()
+    settings = (User.serializer, User.lazy)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                created = populate(count)
+                objs = DATA['User']
+                timings = []
+                for extension, lazy in (("json", False), ("bin", False),
+                                        ("bin", True)):
+                    User.serializer = SERIALIZERS[extension]
+                    User.lazy = lazy
+                    DATA['User'] = objs
+                    User.save_to_file()
+                    start = time.perf_counter()
+                    User.load_from_file()
+                    timings.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                User.get(created[count // 2].id)
+                first_get = (time.perf_counter() - start) * 1e6
+                print("{:>10,}{:>12.3f}{:>12.3f}{:>12.3f}{:>14.1f}".format(
+                    count, *timings, first_get))
+        finally:
+            os.chdir(cwd)
+            User.serializer, User.lazy = settings
+
+
+def probe_memory(count: int) -> float:
+    """ Return the traced bytes per user held by DATA and the indexes
+    after populating count users
+    """
+    tracemalloc.start()
+    created = populate(count)
+    del created
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / count
+
+
+def bench_memory(users: List[int]):
+    """ Bytes per resident user with and without compact models, each
+    measured in a fresh interpreter since MODELS_COMPACT is read at
+    import
+    """
+    print("{:>10}{:>14}{:>14}".format("users", "dict B/user",
+                                      "slots B/user"))
+    for count in users:
+        sizes = []
+        for compact in ("0", "1"):
+            env = dict(os.environ, MODELS_COMPACT=compact)
+            out = subprocess.run(
+                [sys.executable, __file__, "--probe", str(count)],
+                env=env, check=True, capture_output=True, text=True)
+            sizes.append(float(out.stdout))
+        print("{:>10,}{:>14,.0f}{:>14,.0f}".format(count, *sizes))
+
+
+def stress_worker(seed: int, users: List[User], errors: list):
+    """ Run a random mix of reads and writes on the shared store
+    """
+    rng = random.Random(seed)
+    own = []
+    try:
+        for i in range(OPERATIONS):
+            roll = rng.random()
+            if roll < 0.10:
+                user = User(email="t{}-{}@example.com".format(seed, i))
+                user.save()
+                own.append(user)
+            elif roll < 0.15 and own:
+                own.pop(rng.randrange(len(own))).remove()
+            elif roll < 0.20 and own:
+                user = rng.choice(own)
+                user.first_name = "Name{}".format(i)
+                user.save()
+            elif roll < 0.80:
+                User.search({'email': rng.choice(users).email})
+            elif roll < 0.95:
+                User.get(rng.choice(users).id)
+            else:
+                sum(1 for _ in User.iter_search({'first_name': None}))
+    except Exception as e:
+        errors.append(e)
+
+
+def bench_threads(users: List[int]):
+    """ Throughput of a mixed workload shared by several threads, then
+    a check that the store on disk matches the one in memory
+    """
+    print("{:>10}{:>9}{:>12}{:>8}{:>12}".format(
+        "users", "threads", "ops/sec", "errors", "consistent"))
+    cwd = os.getcwd()
+    journal, compact_every = User.journal, User.compact_every
+    User.journal, User.compact_every = True, 200
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                for threads in THREADS:
+                    created = populate(count)
+                    User.save_to_file()
+                    errors = []
+                    workers = [threading.Thread(target=stress_worker,
+                                                args=(i, created, errors))
+                               for i in range(threads)]
+                    start = time.perf_counter()
+                    for worker in workers:
+                        worker.start()
+                    for worker in workers:
+                        worker.join()
+                    elapsed = time.perf_counter() - start
+
+                    expected = {obj_id: obj.to_json(True)
+                                for obj_id, obj in DATA['User'].items()}
+                    User.load_from_file()
+                    loaded = {obj_id: obj.to_json(True)
+                              for obj_id, obj in DATA['User'].items()}
+                    print("{:>10,}{:>9}{:>12,.0f}{:>8}{:>12}".format(
+                        count, threads, threads * OPERATIONS / elapsed,
+                        len(errors), str(expected == loaded)))
+        finally:
+            os.chdir(cwd)
+            User.journal, User.compact_every = journal, compact_every
+
+
+def bench_batch(users: List[int]):
+    """ Import time of users saved one by one and with bulk_save into
+    a JSON snapshot; one by one is skipped above PER_OBJECT_SAVES
+    since it rewrites the file per user
+    """
+    print("{:>10}{:>14}{:>14}".format("users", "per-object s",
+                                      "bulk_save s"))
+    cwd = os.getcwd()
+    journal, serializer = User.journal, User.serializer
+    User.journal, User.serializer = False, SERIALIZERS["json"]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                timings = []
+                for bulk in (False, True):
+                    if not bulk and count > PER_OBJECT_SAVES:
+                        timings.append(float('nan'))
+                        continue
+                    created = populate(count)
+                    DATA['User'] = ObjectStore()
+                    User.rebuild_indexes()
+                    start = time.perf_counter()
+                    if bulk:
+                        User.bulk_save(created)
+                    else:
+                        for user in created:
+                            user.save()
+                    timings.append(time.perf_counter() - start)
+                print("{:>10,}{:>14.3f}{:>14.3f}".format(count, *timings))
+        finally:
+            os.chdir(cwd)
+            User.journal, User.serializer = journal, serializer
+
+
+def bench_latency(users: List[int]):
+    """ Mean latency of a save() with a JSON snapshot per write, with
+    the journal and in write-behind mode, then of the final flush
+    """
+    print("{:>10}{:>14}{:>14}{:>16}{:>10}".format(
+        "users", "snapshot us", "journal us", "write-behind us",
+        "flush s"))
+    cwd = os.getcwd()
+    settings = (User.journal, User.serializer, User.write_behind)
+    User.serializer = SERIALIZERS["json"]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                populate(count)
+                User.journal, User.write_behind = False, False
+                User.save_to_file()
+                timings = []
+                for mode, (journal, write_behind) in enumerate(
+                        ((False, False), (True, False), (False, True))):
+                    User.journal, User.write_behind = journal, write_behind
+                    saves = [User(email="new{}-{}@example.com".format(mode, i))
+                             for i in range(SAVES)]
+                    # a full snapshot per save: a few are enough
+                    timings.append(timed(User.save, saves[:SAVES // 20]
+                                         if not journal and not write_behind
+                                         else saves))
+                start = time.perf_counter()
+                User.flush()
+                flushed = time.perf_counter() - start
+                print("{:>10,}{:>14.1f}{:>14.1f}{:>16.1f}{:>10.3f}".format(
+                    count, *timings, flushed))
+        finally:
+            os.chdir(cwd)
+            User.journal, User.serializer, User.write_behind = settings
+
+
+def bench_storage(users: List[int]):
+    """ Latency of get, email search and save on the file storage
+    (journal mode) and on SQLite storage
+    """
+    print("{:>10}{:>8}{:>10}{:>12}{:>10}{:>10}".format(
+        "users", "storage", "get us", "search us", "save us", "load s"))
+    cwd = os.getcwd()
+    settings = (User.storage, User.journal)
+    User.journal = True
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                created = populate(count)
+                User.save_to_file()
+                step = max(1, count // LOOKUPS)
+                sample = created[::step][:LOOKUPS]
+                sqlite = SQLiteStorage("users{}.sqlite3".format(count))
+                for name, storage in (("file", User.storage),
+                                      ("sqlite", sqlite)):
+                    User.storage = storage
+                    start = time.perf_counter()
+                    User.load()
+                    loaded = time.perf_counter() - start
+                    if name == "sqlite":
+                        User.bulk_save(created)
+                    get = timed(User.get, [user.id for user in sample])
+                    search = timed(User.search, [{'email': user.email}
+                                                 for user in sample])
+                    save = timed(User.save, sample[:SAVES])
+                    print("{:>10,}{:>8}{:>10.1f}{:>12.1f}{:>10.1f}"
+                          "{:>10.3f}".format(count, name, get, search,
+                                             save, loaded))
+                User.storage = settings[0]
+        finally:
+            os.chdir(cwd)
+            User.storage, User.journal = settings
+
+
+def append_users(count: int):
+    """ Save count new users to the journal of the current directory,
+    as another worker process would
+    """
+    User.journal = True
+    User.load_from_file()
+    User.bulk_save(User(email="foreign{}-{}@example.com".format(
+        os.getpid(), i)) for i in range(count))
+
+
+def bench_coherence(users: List[int]):
+    """ Cost of the refresh check on reads when no other process wrote,
+    then of picking up FOREIGN_SAVES saves of another process with a
+    refresh and with a full reload
+    """
+    print("{:>10}{:>12}{:>14}{:>12}{:>12}".format(
+        "users", "get us", "checked us", "refresh s", "reload s"))
+    cwd = os.getcwd()
+    settings = (User.journal, User.refresh_ms)
+    User.journal = True
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                created = populate(count)
+                User.refresh_ms = None
+                User.save_to_file()
+                User.load_from_file()
+                ids = [user.id for user in created[:LOOKUPS]]
+                unchecked = timed(User.get, ids)
+                User.refresh_ms = 0
+                checked = timed(User.get, ids)
+
+                subprocess.run([sys.executable, __file__, "--append",
+                                str(FOREIGN_SAVES)], check=True,
+                               cwd=tmp, env=dict(os.environ,
+                                                 PYTHONPATH=cwd))
+                start = time.perf_counter()
+                User.refresh(force=True)
+                refreshed = time.perf_counter() - start
+                assert User.count() == count + FOREIGN_SAVES
+                start = time.perf_counter()
+                User.load_from_file()
+                reloaded = time.perf_counter() - start
+                print("{:>10,}{:>12.2f}{:>14.2f}{:>12.4f}{:>12.3f}".format(
+                    count, unchecked, checked, refreshed, reloaded))
+        finally:
+            os.chdir(cwd)
+            User.journal, User.refresh_ms = settings
+
+
+def strptime_timestamp(value) -> datetime:
+    """ The previous timestamp parser of Base
+    """
+    if value is None:
+        return datetime.utcnow()
+    if type(value) is datetime:
+        return value
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def strftime_timestamp(value: datetime) -> str:
+    """ The previous timestamp formatting of Base.to_json
+    """
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def bench_timestamps(users: List[int]):
+    """ Load and save time of a JSON snapshot and time to serialize
+    every user as the views do, with the previous strptime/strftime
+    codec and the current one
+    """
+    print("{:>10}{:>10}{:>10}{:>10}{:>12}".format(
+        "users", "codec", "load s", "save s", "to_json s"))
+    cwd = os.getcwd()
+    settings = (User.serializer, User.journal)
+    User.serializer, User.journal = SERIALIZERS["json"], False
+    codecs = (("strptime", staticmethod(strptime_timestamp),
+               staticmethod(strftime_timestamp)),
+              ("iso", Base.__dict__['parse_timestamp'],
+               Base.__dict__['format_timestamp']))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for count in users:
+                populate(count)
+                User.save_to_file()
+                for name, parse, format in codecs:
+                    User.parse_timestamp = parse
+                    User.format_timestamp = format
+                    start = time.perf_counter()
+                    User.load_from_file()
+                    loaded = time.perf_counter() - start
+                    start = time.perf_counter()
+                    for user in User.iter_all():
+                        user.to_json()
+                    serialized = time.perf_counter() - start
+                    start = time.perf_counter()
+                    User.save_to_file()
+                    saved = time.perf_counter() - start
+                    print("{:>10,}{:>10}{:>10.3f}{:>10.3f}{:>12.3f}".format(
+                        count, name, loaded, saved, serialized))
+        finally:
+            os.chdir(cwd)
+            del User.parse_timestamp, User.format_timestamp
+            User.serializer, User.journal = settings
+
+
+BENCHMARKS = {
+    "search": bench_search,
+    "serializers": bench_serializers,
+    "startup": bench_startup,
+    "memory": bench_memory,
+    "threads": bench_threads,
+    "batch": bench_batch,
+    "latency": bench_latency,
+    "storage": bench_storage,
+    "coherence": bench_coherence,
+    "timestamps": bench_timestamps,
+}
+
+
+def main():
+    """ Run the benchmarks named on the command line, all by default
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="one of {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--users", type=int, nargs="+", default=USERS,
+                        help="store sizes, e.g. 1000 100000 1000000")
+    parser.add_argument("--probe", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--append", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.probe:
+        print(probe_memory(args.probe))
+        return
+    if args.append:
+        append_users(args.append)
+        return
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args.users)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,805 @@
 #!/usr/bin/env python3
 """ Base module
 """
-from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import TypeVar, List, Iterable, Iterator, Tuple
+from os import getenv, path
+import atexit
+import fcntl
 import json
+import logging
+import mmap
+import os
+import threading
+import time
 import uuid
+from models.serializers import EPOCH, SERIALIZERS
+from models.storage import SQLiteStorage, Storage
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+TRANSIENT = ('__dict__', '__weakref__')
 DATA = {}
+JOURNAL_SIZES = {}
+INDEXES = {}
+PENDING = object()
+COMPACT = getenv('MODELS_COMPACT', '0') == '1'
+SLOT_NAMES = {}
+BATCHES = threading.local()
+WRITERS = {}
+FILES = {}
+RETRY_MAX_MS = 60000
+LOGGER = logging.getLogger(__name__)
+PROCESS_TOKEN = None
+
+
+def new_process_token():
+    """ Give this process the random token its journal records carry:
+    unlike a PID, it differs between processes of separate containers
+    sharing the files, and a forked child draws its own
+    """
+    global PROCESS_TOKEN
+    PROCESS_TOKEN = os.urandom(8).hex()
+
+
+new_process_token()
+os.register_at_fork(after_in_child=new_process_token)
+
+
+def slots(*names: str) -> tuple:
+    """ __slots__ of a model: its attribute names when compact models
+    are enabled (MODELS_COMPACT=1), none otherwise so that instances
+    keep the __dict__ inherited from Base
+    """
+    return names if COMPACT else ()
+
+
+class ObjectStore(dict):
+    """ Objects of a class keyed by ID, shared between threads
+
+    Lookups are plain dict reads and take no lock. Writes take the
+    store lock, which Base also holds while it persists or indexes
+    the store, and values, items and keys return lists copied under
+    it, so a scan never sees the store change size. Every dict method
+    that writes is overridden to go through the lock.
+
+    The first iter_items_after builds positions, the place of each ID
+    in order, the IDs in store order; both are then kept up to date
+    (a removed ID leaves a None in order until order is compacted), so
+    a cursor seeks instead of scanning.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Initialize an empty store
+        """
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+        self.order = None
+        self.positions = None
+
+    def __setitem__(self, obj_id: str, obj: TypeVar('Base')):
+        """ Store an object under the lock
+        """
+        with self.lock:
+            if self.positions is not None and \
+                    not dict.__contains__(self, obj_id):
+                self.positions[obj_id] = len(self.order)
+                self.order.append(obj_id)
+            super().__setitem__(obj_id, obj)
+
+    def __delitem__(self, obj_id: str):
+        """ Remove an object under the lock
+        """
+        with self.lock:
+            super().__delitem__(obj_id)
+            self.forget(obj_id)
+
+    def pop(self, obj_id: str, *default) -> TypeVar('Base'):
+        """ Remove and return an object under the lock
+        """
+        with self.lock:
+            obj = super().pop(obj_id, *default)
+            self.forget(obj_id)
+            return obj
+
+    def forget(self, obj_id: str):
+        """ Drop a removed ID from positions, compacting order once
+        most of it is holes
+        """
+        if self.positions is None:
+            return
+        position = self.positions.pop(obj_id, None)
+        if position is None:
+            return
+        self.order[position] = None
+        if len(self.order) > 2 * len(self.positions) + 1024:
+            # a new list: walks in progress keep the old one
+            self.order = [key for key in self.order if key is not None]
+            self.positions = {key: i for i, key in enumerate(self.order)}
+
+    def setdefault(self, obj_id: str,
+                   obj: TypeVar('Base') = None) -> TypeVar('Base'):
+        """ Return the object of obj_id, storing obj first when there
+        is none
+        """
+        with self.lock:
+            if obj_id not in self:
+                self[obj_id] = obj
+            return self[obj_id]
+
+    def update(self, *args, **kwargs):
+        """ Store several objects under the lock
+        """
+        with self.lock:
+            for obj_id, obj in dict(*args, **kwargs).items():
+                self[obj_id] = obj
+
+    def __ior__(self, other) -> 'ObjectStore':
+        """ Store the objects of other under the lock
+        """
+        self.update(other)
+        return self
+
+    def popitem(self) -> tuple:
+        """ Remove and return the last stored (ID, object) pair under
+        the lock
+        """
+        with self.lock:
+            if not len(self):
+                raise KeyError("popitem(): store is empty")
+            obj_id = next(reversed(dict.keys(self)))
+            return obj_id, self.pop(obj_id)
+
+    def clear(self):
+        """ Remove every object under the lock
+        """
+        with self.lock:
+            super().clear()
+            self.order = self.positions = None
+
+    def __iter__(self) -> Iterator[str]:
+        """ Iterate over a copy of the IDs
+        """
+        return iter(self.keys())
+
+    def keys(self) -> List[str]:
+        """ Return the IDs, copied under the lock
+        """
+        with self.lock:
+            return list(super().keys())
+
+    def values(self) -> List[TypeVar('Base')]:
+        """ Return the objects, copied under the lock
+        """
+        with self.lock:
+            return list(super().values())
+
+    def items(self) -> List[tuple]:
+        """ Return the (ID, object) pairs, copied under the lock
+        """
+        with self.lock:
+            return list(super().items())
+
+    def iter_items(self) -> Iterator[tuple]:
+        """ Iterate over the (ID, object) pairs of the live dict without
+        copying the store; when another thread resizes it meanwhile, the
+        walk resumes after the last ID reached (or as many pairs in when
+        that one is gone)
+        """
+        last, done = None, 0
+        while True:
+            items = iter(dict.items(self))
+            try:
+                if last is not None and dict.__contains__(self, last):
+                    for obj_id, _ in items:
+                        if obj_id == last:
+                            break
+                else:
+                    next(islice(items, done, done), None)
+                for obj_id, obj in items:
+                    last, done = obj_id, done + 1
+                    yield obj_id, obj
+                return
+            except RuntimeError:
+                # dictionary changed size during iteration
+                continue
+
+    def iter_values(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of the live dict, see iter_items
+        """
+        return (obj for _, obj in self.iter_items())
+
+    def iter_items_after(self, after: str) -> Iterator[tuple]:
+        """ Iterate over the (ID, object) pairs stored after the ID
+        after, in store order, seeking it in positions; raise KeyError,
+        right away, when there is no such ID
+        """
+        with self.lock:
+            if self.positions is None:
+                self.order = list(dict.keys(self))
+                self.positions = {key: i for i, key in enumerate(self.order)}
+            order = self.order
+            start = self.positions.get(after)
+        if start is None:
+            raise KeyError(after)
+        return self.walk_order(order, start + 1)
+
+    def walk_order(self, order: list, start: int) -> Iterator[tuple]:
+        """ Yield the (ID, object) pairs of order from start on, also
+        reaching the IDs appended meanwhile
+        """
+        i = start
+        while i < len(order):
+            obj_id = order[i]
+            i += 1
+            if obj_id is None:
+                continue
+            obj = dict.get(self, obj_id)
+            if obj is not None:
+                yield obj_id, obj
+
+
+class LazyObjects(ObjectStore):
+    """ Objects of a class backed by a memory-mapped snapshot
+
+    Only the ID -> offset index of the snapshot is built up front;
+    each ID maps to PENDING until the object is first read, so the
+    file order of the objects is kept. values and items are iterators
+    over a copy of the IDs that build each object when reached.
+    """
+
+    def __init__(self, cls: type, file_path: str):
+        """ Map the snapshot of cls and index its records
+        """
+        super().__init__()
+        self.cls = cls
+        self.serializer = cls.serializer
+        with open(file_path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.shapes, start = self.serializer.read_shapes(self.data)
+        self.offsets = {}
+        for obj_id, offset in self.serializer.offsets(self.data, start):
+            self.offsets[obj_id] = offset
+            super().__setitem__(obj_id, PENDING)
+
+    def materialize(self, obj_id: str) -> TypeVar('Base'):
+        """ Build the object of a pending ID
+        """
+        with self.lock:
+            obj = dict.get(self, obj_id)
+            if obj is not PENDING:
+                # built or removed by another thread in the meantime
+                return obj
+            offset = self.offsets.pop(obj_id)
+            attributes = self.serializer.decode(
+                self.data, offset, self.shapes)
+            obj = self.cls(**attributes)
+            super().__setitem__(obj_id, obj)
+            if not self.offsets:
+                self.data.close()
+            return obj
+
+    def __getitem__(self, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of obj_id, built if still pending
+        """
+        obj = super().__getitem__(obj_id)
+        if obj is PENDING:
+            return self.materialize(obj_id)
+        return obj
+
+    def get(self, obj_id: str, default=None) -> TypeVar('Base'):
+        """ Return the object of obj_id, built if still pending, or
+        default
+        """
+        obj = super().get(obj_id, default)
+        if obj is PENDING:
+            return self.materialize(obj_id)
+        return obj
+
+    def __setitem__(self, obj_id: str, obj: TypeVar('Base')):
+        """ Store an object, replacing its record in the snapshot
+        """
+        with self.lock:
+            self.offsets.pop(obj_id, None)
+            super().__setitem__(obj_id, obj)
+
+    def __delitem__(self, obj_id: str):
+        """ Remove an object, pending or not
+        """
+        with self.lock:
+            self.offsets.pop(obj_id, None)
+            super().__delitem__(obj_id)
+
+    def pop(self, obj_id: str, *default) -> TypeVar('Base'):
+        """ Remove and return an object, built first if still pending
+        """
+        with self.lock:
+            obj = self.get(obj_id, *default[:1])
+            if obj_id in self:
+                del self[obj_id]
+            elif not default:
+                raise KeyError(obj_id)
+            return obj
+
+    def clear(self):
+        """ Remove every object and unmap the snapshot
+        """
+        with self.lock:
+            self.offsets.clear()
+            super().clear()
+            if not self.data.closed:
+                self.data.close()
+
+    def iter_items(self) -> Iterator[tuple]:
+        """ Iterate over the (ID, object) pairs in file order, building
+        each pending object when reached
+        """
+        return self.built(super().iter_items())
+
+    def walk_order(self, order: list, start: int) -> Iterator[tuple]:
+        """ Yield the (ID, object) pairs of order from start on,
+        building each pending object when reached
+        """
+        return self.built(super().walk_order(order, start))
+
+    def built(self, items: Iterator[tuple]) -> Iterator[tuple]:
+        """ Yield the pairs of items with pending objects built
+        """
+        for obj_id, obj in items:
+            if obj is PENDING:
+                obj = self.materialize(obj_id)
+            if obj is not None:
+                yield obj_id, obj
+
+    def values(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects in file order, building each
+        pending one when reached
+        """
+        return self.iter_values()
+
+    def items(self) -> Iterator[tuple]:
+        """ Iterate over the (ID, object) pairs in file order, building
+        each pending object when reached
+        """
+        return self.iter_items()
+
+    def indexed_values(self, names: List[str]) -> Iterator[tuple]:
+        """ Yield the ID and the values of the named attributes of each
+        object, in file order; pending records are decoded without
+        building their objects
+        """
+        with self.lock:
+            for obj_id, obj in list(dict.items(self)):
+                if obj is PENDING:
+                    attributes = self.serializer.decode(
+                        self.data, self.offsets[obj_id], self.shapes)
+                    yield obj_id, [attributes.get(name) for name in names]
+                else:
+                    yield obj_id, [getattr(obj, name, None)
+                                   for name in names]
+
+
+class Batch():
+    """ Persistence deferred by Base.batch in one thread
+    """
+
+    def __init__(self, max_writes: int = None, max_ms: float = None):
+        """ Initialize an empty batch
+        """
+        self.max_writes = max_writes
+        self.max_ms = max_ms
+        self.records = []
+        self.started = time.monotonic()
+
+    def is_full(self) -> bool:
+        """ True once max_writes writes or max_ms milliseconds have
+        accumulated
+        """
+        if self.max_writes is not None and \
+                len(self.records) >= self.max_writes:
+            return True
+        return self.max_ms is not None and \
+            (time.monotonic() - self.started) * 1000 >= self.max_ms
+
+
+class FileState():
+    """ What a process last read of the files of a class: the identity
+    of the snapshot and how far into the journal it is
+    """
+
+    def __init__(self, snapshot: tuple = None):
+        """ Initialize the state of a freshly read snapshot
+        """
+        self.snapshot = snapshot
+        self.journal = None
+        self.offset = 0
+        self.checked = time.monotonic()
+
+
+def bucket_ids(bucket) -> tuple:
+    """ IDs held by an index bucket: the bucket is the ID itself while a
+    single object has the value, a dict of IDs once several do
+    """
+    if bucket is None:
+        return ()
+    if type(bucket) is str:
+        return (bucket,)
+    return tuple(bucket)
+
+
+def bucket_add(values: dict, value, obj_id: str):
+    """ Add obj_id to the bucket of value in the index values
+    """
+    bucket = values.get(value)
+    if bucket is None:
+        values[value] = obj_id
+    elif type(bucket) is str:
+        if bucket != obj_id:
+            values[value] = {bucket: None, obj_id: None}
+    else:
+        bucket[obj_id] = None
+
+
+def bucket_remove(values: dict, value, obj_id: str):
+    """ Remove obj_id from the bucket of value in the index values
+    """
+    bucket = values.get(value)
+    if bucket is None:
+        return
+    if type(bucket) is str:
+        if bucket == obj_id:
+            del values[value]
+        return
+    bucket.pop(obj_id, None)
+    if len(bucket) == 1:
+        values[value] = next(iter(bucket))
+    elif not bucket:
+        del values[value]
+
+
+def file_key(file_path: str) -> tuple:
+    """ Return what identifies a version of a file, None if missing
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class WriteBehind():
+    """ Background thread persisting the saves and removes of a class
+
+    Records queue up in memory; the thread writes them at once at most
+    max_ms milliseconds after the first of them, as one journal append
+    or one snapshot. Only this writer touches the files of the class,
+    so a snapshot is dumped without holding the store lock. Pending
+    records are flushed at interpreter exit.
+
+    A failed flush is logged, kept in error and retried after a delay
+    that doubles up to RETRY_MAX_MS; once max_pending records wait,
+    check raises so that no more writes are accepted.
+    """
+
+    def __init__(self, cls: type, max_ms: float, max_pending: int):
+        """ Start the writer of cls
+        """
+        self.cls = cls
+        self.max_ms = max_ms
+        self.max_pending = max_pending
+        self.error = None
+        self.records = []
+        self.flushing = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.RLock()
+        self.dirty = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="write-behind-{}".format(cls.__name__),
+            daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def add(self, record: dict):
+        """ Queue a record for the next flush
+        """
+        with self.lock:
+            self.records.append(record)
+        self.dirty.set()
+
+    def check(self):
+        """ Raise RuntimeError, from the last failure, when max_pending
+        records are already waiting
+        """
+        backlog = self.backlog()
+        if backlog >= self.max_pending:
+            raise RuntimeError("{} writes of {} not on disk yet".format(
+                backlog, self.cls.__name__)) from self.error
+
+    def backlog(self) -> int:
+        """ Number of records not on disk yet
+        """
+        with self.lock:
+            return len(self.records) + len(self.flushing)
+
+    def pending_ids(self) -> set:
+        """ IDs of the objects whose records are not on disk yet
+        """
+        with self.lock:
+            return {record['id'] for record in self.records + self.flushing}
+
+    def run(self):
+        """ Flush max_ms after each first pending record until stopped
+        """
+        delay = self.max_ms
+        while not self.stopped.is_set():
+            self.dirty.wait()
+            # let the writes of the next max_ms join this flush
+            self.stopped.wait(delay / 1000)
+            try:
+                self.flush()
+            except Exception:
+                # records are back in the queue
+                delay = min(delay * 2, RETRY_MAX_MS)
+                LOGGER.exception("Write-behind of %s failed, %d records "
+                                 "pending, retrying in %.0f ms",
+                                 self.cls.__name__, self.backlog(), delay)
+            else:
+                delay = self.max_ms
+
+    def flush(self, snapshot: bool = False):
+        """ Write the pending records now, as a snapshot when asked to
+        or when they would fill the journal
+        """
+        cls = self.cls
+        s_class = cls.__name__
+        with self.flush_lock:
+            with self.lock:
+                records, self.records = self.records, []
+                self.flushing = records
+                self.dirty.clear()
+            if not records and not snapshot:
+                return
+            try:
+                if cls.journal and not snapshot and \
+                        JOURNAL_SIZES.get(s_class, 0) + len(records) < \
+                        cls.compact_every:
+                    cls.append_to_journal(*records)
+                else:
+                    with cls.shared_lock():
+                        if cls.journal:
+                            cls.refresh(force=True)
+                        # every queued record is already applied in memory
+                        cls.write_snapshot(DATA[s_class].values())
+            except Exception as e:
+                with self.lock:
+                    self.records[:0] = records
+                self.error = e
+                self.dirty.set()
+                raise
+            else:
+                self.error = None
+            finally:
+                with self.lock:
+                    self.flushing = []
+
+    def stop(self):
+        """ Stop the thread and write what is still pending
+        """
+        self.stopped.set()
+        self.dirty.set()
+        self.flush()
+
+
+class FileStorage(Storage):
+    """ Objects held in DATA by each process and persisted to the
+    .db_<class> files, as configured on Base
+    """
+
+    def load(self, cls: type):
+        """ Load the objects of cls from file
+        """
+        cls.load_from_file()
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of cls with this ID, or None
+        """
+        cls.refresh()
+        return DATA[cls.__name__].get(obj_id)
+
+    def search(self, cls: type, attributes: dict, offset: int = 0,
+               limit: int = None,
+               after: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of cls with matching attributes,
+        scanning only the index bucket of an indexed attribute
+        """
+        def _search(obj):
+            if len(attributes) == 0:
+                return True
+            for k, v in attributes.items():
+                if (getattr(obj, k) != v):
+                    return False
+            return True
+
+        cls.refresh()
+        if after is None:
+            candidates = cls.candidates(attributes)
+        else:
+            candidates = cls.objects_after(after)
+        stop = None if limit is None else offset + limit
+        return islice(filter(_search, candidates), offset, stop)
+
+    def save(self, obj: TypeVar('Base')):
+        """ Store and persist an object
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        with DATA[s_class].lock:
+            if cls.write_behind:
+                cls.writer().check()
+            cls.refresh()
+            obj.check_unique()
+            if not obj.is_stored():
+                previous = DATA[s_class].get(obj.id)
+                if previous is not None:
+                    cls.unindex(previous)
+                DATA[s_class][obj.id] = obj
+                cls.index(obj)
+            cls.persist({
+                'op': 'save', 'id': obj.id, 'obj': obj.to_json(True)
+            })
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Drop and persist the removal of an object
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        with DATA[s_class].lock:
+            if cls.write_behind:
+                cls.writer().check()
+            if DATA[s_class].get(obj.id) is not None:
+                cls.unindex(DATA[s_class][obj.id])
+                del DATA[s_class][obj.id]
+                cls.persist({'op': 'remove', 'id': obj.id})
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of cls
+        """
+        cls.refresh()
+        return len(DATA[cls.__name__])
+
+
+STORAGES = {
+    'file': FileStorage(),
+    'sqlite': SQLiteStorage(),
+}
 
 
 class Base():
     """ Base class
+
+    With journal set (MODELS_JOURNAL=1), save and remove append one
+    record to .db_<class>.journal instead of rewriting the whole
+    .db_<class> snapshot; the journal is folded into the snapshot
+    every compact_every records and replayed by load_from_file.
+
+    indexes maps attribute names to a unique flag; each listed
+    attribute gets a hash index, kept up to date on save, remove and
+    assignment, that search uses instead of scanning every object.
+
+    serializer picks the snapshot format (MODELS_SERIALIZER): "json",
+    or "bin" for the compact binary layout of models.serializers; a
+    snapshot in the other format is converted on load.
+    With lazy set (MODELS_LAZY=1) and a "bin" snapshot, load_from_file
+    only maps the file; objects and indexes are built on first use.
+
+    With refresh_ms set (MODELS_REFRESH_MS), several processes can
+    share the files: reads first apply, at most every refresh_ms
+    milliseconds, the journal records other processes appended and any
+    snapshot they wrote, object by object (see refresh). Writes from
+    several processes need the journal: it is on by default with
+    refresh_ms, and turning it off raises ValueError (at import, or on
+    load when set on the class); compactions are serialized by a lock
+    on .db_<class>.lock.
+
+    storage picks the backend of get, search, save, remove and count
+    (MODELS_STORAGE): "file" keeps the objects in DATA as above,
+    "sqlite" in the database shared by every worker process at
+    MODELS_SQLITE_PATH, in which case the settings above do not apply.
+
+    Subclasses declare __slots__ = slots(<attribute names>); with
+    MODELS_COMPACT=1 objects then hold their attributes in slots
+    instead of a per-instance __dict__.
+
+    With write_behind set (MODELS_WRITE_BEHIND=1), save and remove only
+    update memory and queue their record; a WriteBehind thread writes
+    it within max_staleness_ms (MODELS_MAX_STALENESS_MS) milliseconds,
+    and flush writes everything pending right away. Once
+    max_pending (MODELS_MAX_PENDING) records wait, for instance while
+    the disk fails, save and remove raise RuntimeError before changing
+    anything; writer() exposes the last failure (error) and backlog().
     """
+    if COMPACT:
+        __slots__ = ('id', 'created_at', 'updated_at', '__weakref__')
+    else:
+        __slots__ = ('__dict__', '__weakref__')
+
+    refresh_ms = getenv('MODELS_REFRESH_MS')
+    refresh_ms = None if refresh_ms is None else float(refresh_ms)
+    # shared files default to the journal, which they cannot do without
+    journal = getenv('MODELS_JOURNAL',
+                     '0' if refresh_ms is None else '1') == '1'
+    if refresh_ms is not None and not journal:
+        raise ValueError("MODELS_REFRESH_MS needs MODELS_JOURNAL=1")
+    compact_every = int(getenv('MODELS_JOURNAL_COMPACT_EVERY', '1000'))
+    indexes = {}
+    serializer = SERIALIZERS[getenv('MODELS_SERIALIZER', 'json')]
+    lazy = getenv('MODELS_LAZY', '0') == '1'
+    storage = STORAGES[getenv('MODELS_STORAGE', 'file')]
+    write_behind = getenv('MODELS_WRITE_BEHIND', '0') == '1'
+    max_staleness_ms = float(getenv('MODELS_MAX_STALENESS_MS', '1000'))
+    max_pending = int(getenv('MODELS_MAX_PENDING', '100000'))
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
         if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+            DATA.setdefault(s_class, ObjectStore())
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
-        if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+        if 'id' in kwargs:
+            self.id = kwargs['id']
         else:
-            self.created_at = datetime.utcnow()
-        if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.id = str(uuid.uuid4())
+        self.created_at = self.parse_timestamp(kwargs.get('created_at'))
+        self.updated_at = self.parse_timestamp(kwargs.get('updated_at'))
+
+    @staticmethod
+    def parse_timestamp(value) -> datetime:
+        """ Return value as a datetime: now when missing, as is when
+        already a datetime, from seconds since the epoch when a number,
+        parsed as ISO 8601 (TIMESTAMP_FORMAT) otherwise
+        """
+        if value is None:
+            return datetime.utcnow()
+        if type(value) is datetime:
+            return value
+        if type(value) in (int, float):
+            return EPOCH + timedelta(seconds=value)
+        return datetime.fromisoformat(value)
+
+    @staticmethod
+    def format_timestamp(value: datetime) -> str:
+        """ Return value formatted with TIMESTAMP_FORMAT
+        """
+        return value.isoformat(timespec='seconds')
+
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, moving the object in the index of the
+        attribute when it is indexed and the object is stored; raise
+        ValueError, leaving the object as is, when the new value of a
+        unique attribute belongs to another stored object
+        """
+        if name in self.indexes and self.is_stored():
+            with DATA[self.__class__.__name__].lock:
+                if self.indexes[name] and \
+                        value != getattr(self, name, None):
+                    self.check_unique_value(name, value)
+                self.__class__.unindex(self, (name,))
+                super().__setattr__(name, value)
+                self.__class__.index(self, (name,))
         else:
-            self.updated_at = datetime.utcnow()
+            super().__setattr__(name, value)
+
+    def is_stored(self) -> bool:
+        """ True if this very object is the one held in DATA
+        """
+        s_class = self.__class__.__name__
+        obj_id = getattr(self, 'id', None)
+        # plain dict lookup: never materialize a lazily loaded object
+        return dict.get(DATA.get(s_class, {}), obj_id) is self
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -44,94 +810,593 @@ class Base():
             return False
         return (self.id == other.id)
 
+    @classmethod
+    def slot_names(cls) -> tuple:
+        """ Return the attribute slots of the class, base classes first
+        """
+        names = SLOT_NAMES.get(cls)
+        if names is None:
+            names = tuple(
+                name for klass in reversed(cls.__mro__)
+                for name in klass.__dict__.get('__slots__', ())
+                if name not in TRANSIENT)
+            SLOT_NAMES[cls] = names
+        return names
+
+    def to_record(self) -> dict:
+        """ Return every attribute of the object, unconverted
+        """
+        record = {}
+        for name in self.slot_names():
+            value = getattr(self, name, PENDING)
+            if value is not PENDING:
+                record[name] = value
+        record.update(getattr(self, '__dict__', {}))
+        return record
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
         result = {}
-        for key, value in self.__dict__.items():
+        for key, value in self.to_record().items():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
+                result[key] = self.format_timestamp(value)
             else:
                 result[key] = value
         return result
 
+    @classmethod
+    def load(cls):
+        """ Make the objects available from the storage of the class
+        """
+        cls.storage.load(cls)
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file, then replay the journal
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
+        if cls.refresh_ms is not None and not cls.journal:
+            # each process would write its own snapshot over the others
+            raise ValueError("{}: refresh_ms needs the journal".format(
+                s_class))
+        cls.flush()
+        file_path = ".db_{}.{}".format(s_class, cls.serializer.extension)
         if not path.exists(file_path):
+            cls.migrate_snapshot()
+        objs = ObjectStore()
+        JOURNAL_SIZES[s_class] = 0
+        lazy = cls.lazy and hasattr(cls.serializer, 'offsets')
+        journal_path = ".db_{}.journal".format(s_class)
+        # no other process may compact between the two reads
+        with cls.shared_lock():
+            state = FileState(file_key(file_path))
+            if path.exists(file_path):
+                if lazy:
+                    objs = LazyObjects(cls, file_path)
+                else:
+                    for obj_id, attributes in cls.serializer.load(
+                            file_path):
+                        objs[obj_id] = cls(**attributes)
+
+            state.journal = file_key(journal_path)
+            if state.journal is not None:
+                state.offset = cls.replay_journal(journal_path, objs)
+
+        # the new store replaces the old one in a single assignment
+        INDEXES[s_class] = None if lazy else cls.build_indexes(objs)
+        DATA[s_class] = objs
+        FILES[s_class] = state
+
+    @classmethod
+    def migrate_snapshot(cls):
+        """ Rewrite a snapshot left in another format (MODELS_SERIALIZER
+        changed since it was written) in the format of the class, so
+        the objects are kept; the journal does not depend on the format
+        """
+        s_class = cls.__name__
+        file_path = ".db_{}.{}".format(s_class, cls.serializer.extension)
+        for serializer in SERIALIZERS.values():
+            old_path = ".db_{}.{}".format(s_class, serializer.extension)
+            if serializer is cls.serializer or not path.exists(old_path):
+                continue
+            with cls.shared_lock():
+                try:
+                    objs = [cls(**attributes) for _, attributes
+                            in serializer.load(old_path)]
+                except FileNotFoundError:
+                    # migrated by another process in the meantime
+                    return
+                tmp_path = "{}.tmp".format(file_path)
+                cls.serializer.dump(tmp_path, objs)
+                os.replace(tmp_path, file_path)
+                os.remove(old_path)
+            return
+
+    @classmethod
+    def read_journal(cls, journal_path: str,
+                     offset: int = 0) -> Tuple[List[dict], int]:
+        """ Return the records of the journal from offset on and the
+        offset of their end; a last line still being written is left
+        for the next read
+        """
+        with open(journal_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # record cut short by a crash during the append
+                continue
+        return records, offset + end
+
+    @classmethod
+    def replay_journal(cls, journal_path: str, objs: ObjectStore) -> int:
+        """ Apply the records of the journal to the loaded objects and
+        return the offset reached
+        """
+        s_class = cls.__name__
+        records, offset = cls.read_journal(journal_path)
+        for record in records:
+            if record['op'] == 'save':
+                objs[record['id']] = cls(**record['obj'])
+            else:
+                objs.pop(record['id'], None)
+            JOURNAL_SIZES[s_class] += 1
+        return offset
+
+    @classmethod
+    def refresh(cls, force: bool = False):
+        """ Apply what other processes wrote since the last load or
+        refresh, checked at most every refresh_ms milliseconds unless
+        forced: a new snapshot is merged object by object, then the
+        journal records appended by other processes (all of them after
+        a merge, which may drop objects only in the journal) are applied.
+        Objects with writes not on disk yet are left alone.
+        """
+        s_class = cls.__name__
+        state = FILES.get(s_class)
+        if state is None or cls.refresh_ms is None:
+            return
+        now = time.monotonic()
+        if not force and (now - state.checked) * 1000 < cls.refresh_ms:
+            return
+        state.checked = now
+        file_path = ".db_{}.{}".format(s_class, cls.serializer.extension)
+        journal_path = ".db_{}.journal".format(s_class)
+        snapshot = file_key(file_path)
+        journal = file_key(journal_path)
+        if snapshot == state.snapshot and journal == state.journal:
+            return
+
+        with DATA[s_class].lock:
+            writer = WRITERS.get(s_class)
+            pending = writer.pending_ids() if writer is not None else set()
+            snapshot = file_key(file_path)
+            merged = snapshot != state.snapshot
+            if merged:
+                cls.merge_snapshot(file_path, pending)
+                state.snapshot = snapshot
+                state.offset = 0
+                JOURNAL_SIZES[s_class] = 0
+            journal = file_key(journal_path)
+            if journal is None or state.journal is None or \
+                    journal[0] != state.journal[0] or \
+                    journal[2] < state.offset:
+                # a new journal since the last read
+                state.offset = 0
+            if journal is not None:
+                records, state.offset = cls.read_journal(journal_path,
+                                                         state.offset)
+                for record in records:
+                    if record.get('token') == PROCESS_TOKEN and \
+                            not merged:
+                        # counted and applied when appended; after a
+                        # merge they are needed again
+                        continue
+                    JOURNAL_SIZES[s_class] = \
+                        JOURNAL_SIZES.get(s_class, 0) + 1
+                    if record['id'] not in pending:
+                        cls.apply_record(record)
+            state.journal = journal
+
+    @classmethod
+    def merge_snapshot(cls, file_path: str, pending: set = ()):
+        """ Make the stored objects match a snapshot written by another
+        process, replacing only the objects that differ
+        """
+        objs = DATA[cls.__name__]
+        seen = set()
+        if path.exists(file_path):
+            for obj_id, attributes in cls.serializer.load(file_path):
+                seen.add(obj_id)
+                if obj_id not in pending:
+                    cls.apply_record({'op': 'save', 'id': obj_id,
+                                      'obj': attributes})
+        for obj_id in objs.keys():
+            if obj_id not in seen and obj_id not in pending:
+                cls.apply_record({'op': 'remove', 'id': obj_id})
+
+    @classmethod
+    def apply_record(cls, record: dict):
+        """ Apply a save or remove record to the stored objects and
+        their indexes, keeping an unchanged object as is
+        """
+        objs = DATA[cls.__name__]
+        existing = objs.get(record['id'])
+        if record['op'] == 'save':
+            obj = cls(**record['obj'])
+            if existing is not None:
+                if existing.to_json(True) == obj.to_json(True):
+                    return
+                cls.unindex(existing)
+            objs[obj.id] = obj
+            cls.index(obj)
+        elif existing is not None:
+            cls.unindex(existing)
+            del objs[record['id']]
+
+    @classmethod
+    @contextmanager
+    def shared_lock(cls):
+        """ Hold the lock that serializes the file writes of every
+        process, when the files are shared (refresh_ms set)
+        """
+        if cls.refresh_ms is None:
+            yield
+            return
+        with open(".db_{}.lock".format(cls.__name__), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @classmethod
+    def build_indexes(cls, objs: ObjectStore) -> dict:
+        """ Return the indexes of the given objects
+        """
+        names = list(cls.indexes)
+        indexes = {name: {} for name in names}
+        if isinstance(objs, LazyObjects):
+            rows = objs.indexed_values(names)
+        else:
+            rows = ((obj.id, [getattr(obj, name, None) for name in names])
+                    for obj in objs.values())
+        for obj_id, values in rows:
+            for name, value in zip(names, values):
+                try:
+                    bucket_add(indexes[name], value, obj_id)
+                except TypeError:
+                    # unhashable values are left to the search scan
+                    continue
+        return indexes
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """ Build the indexes of all objects from scratch
+        """
+        objs = DATA[cls.__name__]
+        with objs.lock:
+            INDEXES[cls.__name__] = cls.build_indexes(objs)
+
+    @classmethod
+    def get_indexes(cls) -> dict:
+        """ Return the indexes of the class, building them first if a
+        lazy load left them unbuilt
+        """
+        if INDEXES.get(cls.__name__, {}) is None:
+            with DATA[cls.__name__].lock:
+                if INDEXES.get(cls.__name__, {}) is None:
+                    cls.rebuild_indexes()
+        return INDEXES.get(cls.__name__, {})
+
+    @classmethod
+    def index(cls, obj: TypeVar('Base'), names: Iterable[str] = None,
+              indexes: dict = None):
+        """ Add an object to the indexes of the given attributes,
+        all of them by default
+        """
+        if indexes is None:
+            indexes = INDEXES.setdefault(cls.__name__, {})
+        if indexes is None:
+            return
+        for name in names or cls.indexes:
+            try:
+                bucket_add(indexes.setdefault(name, {}),
+                           getattr(obj, name, None), obj.id)
+            except TypeError:
+                # unhashable values are left to the search scan
+                continue
+
+    @classmethod
+    def unindex(cls, obj: TypeVar('Base'), names: Iterable[str] = None):
+        """ Remove an object from the indexes of the given attributes,
+        all of them by default
+        """
+        indexes = INDEXES.get(cls.__name__) or {}
+        for name in names or cls.indexes:
+            try:
+                bucket_remove(indexes.get(name, {}),
+                              getattr(obj, name, None), obj.id)
+            except TypeError:
+                continue
+
+    def check_unique(self):
+        """ Raise ValueError if another stored object has the same
+        value for a unique index; values unchanged since the object was
+        stored are not checked, so duplicates stored before the index
+        was unique can still be saved
+        """
+        if not any(self.indexes.values()):
             return
+        previous = DATA.get(self.__class__.__name__, {}).get(self.id)
+        for name, unique in self.indexes.items():
+            value = getattr(self, name, None)
+            if not unique or (previous is not None and
+                              getattr(previous, name, None) == value):
+                continue
+            self.check_unique_value(name, value)
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    def check_unique_value(self, name: str, value):
+        """ Raise ValueError if another stored object has this value for
+        the unique index name
+        """
+        if value is None:
+            return
+        indexes = self.__class__.get_indexes()
+        try:
+            bucket = indexes.get(name, {}).get(value)
+        except TypeError:
+            return
+        if any(obj_id != self.id for obj_id in bucket_ids(bucket)):
+            raise ValueError("{} {} already exists".format(name, value))
 
     @classmethod
     def save_to_file(cls):
-        """ Save all objects to file
+        """ Save all objects to file, which makes the journal obsolete
+        """
+        s_class = cls.__name__
+        if cls.write_behind:
+            cls.writer().flush(snapshot=True)
+            return
+        with DATA[s_class].lock:
+            with cls.shared_lock():
+                if cls.journal:
+                    # fold in what other processes appended meanwhile
+                    cls.refresh(force=True)
+                cls.write_snapshot(DATA[s_class].values())
+
+    @classmethod
+    def write_snapshot(cls, objs: Iterable[TypeVar('Base')]):
+        """ Write objs as the snapshot of the class and drop the journal
+        """
+        s_class = cls.__name__
+        file_path = ".db_{}.{}".format(s_class, cls.serializer.extension)
+        # written aside then renamed over the snapshot, so readers
+        # (and a lazy mapping) never see a partial file
+        tmp_path = "{}.tmp".format(file_path)
+        cls.serializer.dump(tmp_path, objs)
+        os.replace(tmp_path, file_path)
+
+        journal_path = ".db_{}.journal".format(s_class)
+        if path.exists(journal_path):
+            os.remove(journal_path)
+        JOURNAL_SIZES[s_class] = 0
+        state = FILES.get(s_class)
+        if state is not None:
+            state.snapshot = file_key(file_path)
+            state.journal = None
+            state.offset = 0
+
+    @classmethod
+    def compact(cls):
+        """ Fold the journal into a new snapshot
+        """
+        cls.save_to_file()
+
+    @classmethod
+    def append_to_journal(cls, *records: dict):
+        """ Append records to the journal in one write, compacting it
+        once it holds compact_every records
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        # tagged so that refresh skips the records of this process
+        lines = "".join(json.dumps(dict(record, token=PROCESS_TOKEN)) + "\n"
+                        for record in records)
+        with cls.shared_lock():
+            with open(journal_path, 'a') as f:
+                f.write(lines)
+        JOURNAL_SIZES[s_class] = JOURNAL_SIZES.get(s_class, 0) + len(records)
+        if JOURNAL_SIZES[s_class] >= cls.compact_every:
+            cls.compact()
+
+    @classmethod
+    def persist(cls, record: dict):
+        """ Write a save or remove record to disk: appended to the
+        journal, or as a new snapshot; deferred inside a batch, queued
+        for the background writer in write-behind mode
+        """
+        batch = getattr(BATCHES, cls.__name__, None)
+        if cls.write_behind:
+            cls.writer().add(record)
+        elif batch is not None:
+            batch.records.append(record)
+            if batch.is_full():
+                cls.flush_batch(batch)
+        elif cls.journal:
+            cls.append_to_journal(record)
+        else:
+            cls.save_to_file()
+
+    @classmethod
+    def flush_batch(cls, batch: Batch):
+        """ Write the records deferred by a batch at once
+        """
+        if not batch.records:
+            # nothing written in the block, or a storage that does not
+            # defer (the class may have no store loaded at all)
+            batch.started = time.monotonic()
+            return
+        with DATA[cls.__name__].lock:
+            if cls.journal:
+                cls.append_to_journal(*batch.records)
+            else:
+                cls.save_to_file()
+            batch.records = []
+            batch.started = time.monotonic()
+
+    @classmethod
+    def writer(cls) -> WriteBehind:
+        """ Return the background writer of the class, started on
+        first use
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        writer = WRITERS.get(s_class)
+        if writer is None:
+            with DATA[s_class].lock:
+                writer = WRITERS.get(s_class)
+                if writer is None:
+                    writer = WriteBehind(cls, cls.max_staleness_ms,
+                                         cls.max_pending)
+                    WRITERS[s_class] = writer
+        return writer
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def flush(cls):
+        """ Write the records queued for the background writer now
+        """
+        writer = WRITERS.get(cls.__name__)
+        if writer is not None:
+            writer.flush()
+
+    @classmethod
+    @contextmanager
+    def batch(cls, max_writes: int = None, max_ms: float = None):
+        """ Defer the writes of the saves and removes made by this
+        thread in the block and write them at once when it exits, or
+        each time max_writes writes or max_ms milliseconds accumulate;
+        with SQLite storage the block is one transaction. There is no
+        timer: max_ms is checked on each save or remove, so writes
+        deferred before a pause in the block wait for the next write
+        or the end of the block.
+        """
+        s_class = cls.__name__
+        if getattr(BATCHES, s_class, None) is not None:
+            # nested: the outer batch writes everything
+            yield
+            return
+        batch = Batch(max_writes, max_ms)
+        setattr(BATCHES, s_class, batch)
+        try:
+            with cls.storage.transaction():
+                yield
+        finally:
+            delattr(BATCHES, s_class)
+            cls.flush_batch(batch)
+
+    @classmethod
+    def bulk_save(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save many objects with a single write
+        """
+        with cls.batch():
+            for obj in objs:
+                obj.save()
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        self.storage.save(self)
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        self.storage.remove(self)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return cls.storage.count(cls)
 
     @classmethod
-    def all(cls) -> Iterable[TypeVar('Base')]:
+    def all(cls, offset: int = 0, limit: int = None,
+            after: str = None) -> Iterable[TypeVar('Base')]:
         """ Return all objects
         """
-        return cls.search()
+        return cls.search({}, offset, limit, after)
+
+    @classmethod
+    def iter_all(cls, offset: int = 0, limit: int = None,
+                 after: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate lazily over all objects
+        """
+        return cls.iter_search({}, offset, limit, after)
 
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return cls.storage.get(cls, id)
 
     @classmethod
-    def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
+    def search(cls, attributes: dict = {}, offset: int = 0,
+               limit: int = None,
+               after: str = None) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        return list(cls.iter_search(attributes, offset, limit, after))
+
+    @classmethod
+    def iter_search(cls, attributes: dict = {}, offset: int = 0,
+                    limit: int = None,
+                    after: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate lazily over the objects with matching attributes,
+        skipping the first offset matches and stopping after limit
+        ones; the scan only goes as far as the consumer does. With
+        after, only the objects stored after the object of that ID are
+        searched; KeyError is raised when there is no such object.
+        """
+        return cls.storage.search(cls, attributes, offset, limit, after)
+
+    @classmethod
+    def first(cls, attributes: dict = {}) -> TypeVar('Base'):
+        """ Return the first object with matching attributes, or None
+        """
+        return next(cls.iter_search(attributes, 0, 1), None)
+
+    @classmethod
+    def objects_after(cls, obj_id: str) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects stored after the object of obj_id,
+        in store order; raise KeyError when there is no such object
+        """
+        items = DATA[cls.__name__].iter_items_after(obj_id)
+        return (obj for _, obj in items)
+
+    @classmethod
+    def candidates(cls, attributes: dict) -> Iterable[TypeVar('Base')]:
+        """ Return the objects that may match the attributes: the
+        bucket of the first indexed attribute, or every object
+        """
+        objs = DATA[cls.__name__]
+        if not any(k in cls.indexes for k in attributes):
+            return objs.iter_values()
+        indexes = cls.get_indexes()
+        for k, v in attributes.items():
+            if k not in indexes:
+                continue
+            try:
+                bucket = indexes[k].get(v)
+            except TypeError:
+                continue
+            # copied first: a writer may change the bucket meanwhile
+            found = [objs.get(obj_id) for obj_id in bucket_ids(bucket)]
+            return [obj for obj in found if obj is not None]
+        return objs.iter_values()
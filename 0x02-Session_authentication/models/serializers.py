@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+""" Serializers module: on-disk formats of the Base file store
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, Tuple
+import json
+import struct
+
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class JSONSerializer():
+    """ One JSON object of objects keyed by ID, timestamps as strings
+    """
+    extension = "json"
+
+    def dump(self, file_path: str, objs: Iterable):
+        """ Write the objects to file_path
+        """
+        objs_json = {}
+        for obj in objs:
+            objs_json[obj.id] = obj.to_json(True)
+        with open(file_path, 'w') as f:
+            json.dump(objs_json, f)
+
+    def load(self, file_path: str) -> Iterator[Tuple[str, dict]]:
+        """ Yield (ID, attributes) for each object of file_path
+        """
+        with open(file_path, 'r') as f:
+            objs_json = json.load(f)
+        return iter(objs_json.items())
+
+
+class BinarySerializer():
+    """ Compact binary layout
+
+    After the MAGIC header comes the JSON (UTF-8) list of shapes, each
+    the attribute names of a kind of object and the positions of its
+    datetime attributes, then one record per object:
+
+        <I record length> <H ID length> <H shape> <ID> <values>
+
+    Each value is a tag byte followed by its data, all little-endian:
+    N, T and F for None, True and False, i for a signed 64-bit integer,
+    f for a double, s for a UTF-8 string and j for the UTF-8 JSON of
+    anything else, both after their <I length>. Datetimes are stored as
+    integer microseconds since the epoch. The layout only depends on
+    struct, so it reads the same on every Python version, and reading a
+    file never runs code from it. The ID sits outside the values so a
+    reader can index records without decoding.
+    """
+    extension = "bin"
+    MAGIC = b"BDB2"
+    HEADER = struct.Struct("<I")
+    RECORD = struct.Struct("<IHH")
+    INT = struct.Struct("<cq")
+    FLOAT = struct.Struct("<cd")
+    SIZED = struct.Struct("<cI")
+    INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+    def pack(self, values: Iterable) -> bytes:
+        """ Return the tagged encoding of values
+        """
+        parts = []
+        for value in values:
+            kind = type(value)
+            if value is None:
+                parts.append(b"N")
+            elif kind is bool:
+                parts.append(b"T" if value else b"F")
+            elif kind is int and self.INT_MIN <= value <= self.INT_MAX:
+                parts.append(self.INT.pack(b"i", value))
+            elif kind is float:
+                parts.append(self.FLOAT.pack(b"f", value))
+            elif kind is str:
+                data = value.encode('utf-8')
+                parts.append(self.SIZED.pack(b"s", len(data)))
+                parts.append(data)
+            else:
+                data = json.dumps(value).encode('utf-8')
+                parts.append(self.SIZED.pack(b"j", len(data)))
+                parts.append(data)
+        return b"".join(parts)
+
+    def unpack(self, data: bytes, offset: int, end: int) -> list:
+        """ Return the values encoded in data[offset:end]
+        """
+        values = []
+        append = values.append
+        int_from = self.INT.unpack_from
+        float_from = self.FLOAT.unpack_from
+        sized_from = self.SIZED.unpack_from
+        while offset < end:
+            tag = data[offset]
+            if tag == 0x73:  # s
+                _, size = sized_from(data, offset)
+                offset += 5
+                append(str(data[offset:offset + size], 'utf-8'))
+                offset += size
+            elif tag == 0x69:  # i
+                append(int_from(data, offset)[1])
+                offset += 9
+            elif tag == 0x4e:  # N
+                append(None)
+                offset += 1
+            elif tag == 0x54 or tag == 0x46:  # T, F
+                append(tag == 0x54)
+                offset += 1
+            elif tag == 0x66:  # f
+                append(float_from(data, offset)[1])
+                offset += 9
+            elif tag == 0x6a:  # j
+                _, size = sized_from(data, offset)
+                offset += 5
+                append(json.loads(str(data[offset:offset + size],
+                                      'utf-8')))
+                offset += size
+            else:
+                raise ValueError("Unknown value tag {!r} at {}".format(
+                    chr(tag), offset))
+        return values
+
+    def dump(self, file_path: str, objs: Iterable):
+        """ Write the objects to file_path
+        """
+        shapes: Dict[tuple, int] = {}
+        records = []
+        for obj in objs:
+            attributes = obj.to_record()
+            keys = tuple(attributes)
+            dates = tuple(i for i, value in enumerate(attributes.values())
+                          if type(value) is datetime)
+            shape = shapes.setdefault((keys, dates), len(shapes))
+            values = list(attributes.values())
+            for i in dates:
+                values[i] = (values[i] - EPOCH) // MICROSECOND
+            obj_id = obj.id.encode('utf-8')
+            payload = self.pack(values)
+            records.append(self.RECORD.pack(
+                self.RECORD.size - 4 + len(obj_id) + len(payload),
+                len(obj_id), shape))
+            records.append(obj_id)
+            records.append(payload)
+
+        header = json.dumps(list(shapes)).encode('utf-8')
+        with open(file_path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.HEADER.pack(len(header)))
+            f.write(header)
+            f.writelines(records)
+
+    def read_shapes(self, data: bytes) -> Tuple[list, int]:
+        """ Return the shapes of a file and the offset of its first record
+        """
+        if data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError("Not a {} file".format(type(self).__name__))
+        start = len(self.MAGIC) + self.HEADER.size
+        size, = self.HEADER.unpack_from(data, len(self.MAGIC))
+        shapes = json.loads(str(data[start:start + size], 'utf-8'))
+        return [(tuple(keys), tuple(dates)) for keys, dates in shapes], \
+            start + size
+
+    def offsets(self, data: bytes, start: int) -> Iterator[Tuple[str, int]]:
+        """ Yield (ID, offset) for each record from start on
+        """
+        unpack_from = self.RECORD.unpack_from
+        size = self.RECORD.size
+        end = len(data)
+        offset = start
+        while offset < end:
+            length, id_length, _ = unpack_from(data, offset)
+            obj_id = bytes(data[offset + size:offset + size + id_length])
+            yield obj_id.decode('utf-8'), offset
+            offset += 4 + length
+
+    def decode(self, data: bytes, offset: int, shapes: list) -> dict:
+        """ Return the attributes of the record at offset
+        """
+        length, id_length, shape = self.RECORD.unpack_from(data, offset)
+        start = offset + self.RECORD.size + id_length
+        values = self.unpack(data, start, offset + 4 + length)
+        keys, dates = shapes[shape]
+        for i in dates:
+            values[i] = EPOCH + values[i] * MICROSECOND
+        return dict(zip(keys, values))
+
+    def load(self, file_path: str) -> Iterator[Tuple[str, dict]]:
+        """ Yield (ID, attributes) for each object of file_path
+        """
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        shapes, start = self.read_shapes(data)
+        for obj_id, offset in self.offsets(data, start):
+            yield obj_id, self.decode(data, offset, shapes)
+
+
+SERIALIZERS = {
+    JSONSerializer.extension: JSONSerializer(),
+    BinarySerializer.extension: BinarySerializer(),
+}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+""" Storage module: where the objects of the models live
+"""
+from contextlib import contextmanager
+from itertools import islice
+from os import getenv
+from typing import Iterator, TypeVar
+import json
+import os
+import sqlite3
+import threading
+
+
+class Storage():
+    """ Backend of the models: Base.get, search, save, remove and count
+    are forwarded to the storage of the class
+    """
+
+    def load(self, cls: type):
+        """ Make the objects of cls available
+        """
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of cls with this ID, or None
+        """
+        raise NotImplementedError
+
+    def search(self, cls: type, attributes: dict, offset: int = 0,
+               limit: int = None,
+               after: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of cls with matching attributes,
+        only among the objects stored after the object of ID after when
+        given; raise KeyError when there is no such object
+        """
+        raise NotImplementedError
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or update an object; raise ValueError when a unique
+        attribute is already taken
+        """
+        raise NotImplementedError
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+        raise NotImplementedError
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of cls
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """ Group the writes made in the block
+        """
+        yield
+
+
+class SQLiteStorage(Storage):
+    """ Objects in one SQLite database shared by every worker process
+
+    Each class gets a table holding the ID, one column per attribute
+    listed in its indexes (with an index, unique when flagged) and the
+    JSON of the object. The database runs in WAL mode, so readers of
+    other processes go on during a write. Every statement is a fixed
+    string with placeholders, built once per class, so sqlite3 reuses
+    its prepared statement from the connection cache.
+    """
+
+    def __init__(self, file_path: str = None):
+        """ Use the database at file_path, MODELS_SQLITE_PATH by default
+        """
+        self.file_path = file_path or getenv('MODELS_SQLITE_PATH',
+                                             '.db.sqlite3')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.statements = {}
+
+    def connection(self) -> sqlite3.Connection:
+        """ Return the connection of the current thread, opened by this
+        process: a worker forked after the parent connected (gunicorn
+        --preload) must not share the handle it inherited
+        """
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.file_path, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+            self.local.depth = 0
+        return db
+
+    def table(self, cls: type) -> dict:
+        """ Create the table of cls if needed and return its statements
+        """
+        statements = self.statements.get(cls.__name__)
+        if statements is not None:
+            return statements
+        with self.lock:
+            statements = self.statements.get(cls.__name__)
+            if statements is not None:
+                return statements
+            table = '"{}"'.format(cls.__name__)
+            columns = ['"{}"'.format(name) for name in cls.indexes]
+            db = self.connection()
+            db.execute("CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY "
+                       "KEY, {}data TEXT NOT NULL)".format(
+                           table, "".join(c + ", " for c in columns)))
+            for name, unique in cls.indexes.items():
+                db.execute('CREATE {}INDEX IF NOT EXISTS "{}_{}" '
+                           'ON {} ("{}")'.format(
+                               "UNIQUE " if unique else "",
+                               cls.__name__, name, table, name))
+            statements = {
+                'get': "SELECT data FROM {} WHERE id = ?".format(table),
+                'rowid': "SELECT rowid FROM {} WHERE id = ?".format(table),
+                'count': "SELECT COUNT(*) FROM {}".format(table),
+                'delete': "DELETE FROM {} WHERE id = ?".format(table),
+                'save': "INSERT INTO {} (id, {}data) VALUES ({}?) "
+                        "ON CONFLICT(id) DO UPDATE SET {}data = "
+                        "excluded.data".format(
+                            table, "".join(c + ", " for c in columns),
+                            "?, " * (len(columns) + 1),
+                            "".join("{0} = excluded.{0}, ".format(c)
+                                    for c in columns)),
+                'select': "SELECT data FROM {}{} ORDER BY rowid "
+                          "LIMIT ? OFFSET ?",
+                'table': table,
+            }
+            self.statements[cls.__name__] = statements
+            return statements
+
+    def load(self, cls: type):
+        """ Create the table of cls
+        """
+        self.table(cls)
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of cls with this ID, or None
+        """
+        row = self.connection().execute(
+            self.table(cls)['get'], (obj_id,)).fetchone()
+        return None if row is None else cls(**json.loads(row[0]))
+
+    def search(self, cls: type, attributes: dict, offset: int = 0,
+               limit: int = None,
+               after: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of cls with matching attributes;
+        indexed attributes are matched by SQLite, the others here
+        """
+        statements = self.table(cls)
+        db = self.connection()
+        indexed = sorted(k for k in attributes if k in cls.indexes)
+        others = {k: v for k, v in attributes.items() if k not in indexed}
+        conditions = ['"{}" IS ?'.format(k) for k in indexed]
+        params = [attributes[k] for k in indexed]
+        if after is not None:
+            row = db.execute(statements['rowid'], (after,)).fetchone()
+            if row is None:
+                raise KeyError(after)
+            conditions.append("rowid > ?")
+            params.append(row[0])
+        where = " AND ".join(conditions)
+        sql = statements['select'].format(
+            statements['table'], " WHERE " + where if where else "")
+        if others:
+            # offset and limit count matches of the remaining attributes
+            params += [-1, 0]
+        else:
+            params += [-1 if limit is None else limit, offset]
+        rows = db.execute(sql, params)
+        objs = (cls(**json.loads(data)) for data, in rows)
+        if not others:
+            return objs
+        stop = None if limit is None else offset + limit
+        return islice((obj for obj in objs
+                       if all(getattr(obj, k) == v
+                              for k, v in others.items())),
+                      offset, stop)
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or update an object
+        """
+        cls = obj.__class__
+        statements = self.table(cls)
+        params = [obj.id]
+        params += [getattr(obj, name, None) for name in cls.indexes]
+        params.append(json.dumps(obj.to_json(True)))
+        try:
+            self.connection().execute(statements['save'], params)
+        except sqlite3.IntegrityError as e:
+            for name, unique in cls.indexes.items():
+                if unique and str(e).endswith(".{}".format(name)):
+                    raise ValueError("{} {} already exists".format(
+                        name, getattr(obj, name, None))) from e
+            raise
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+        self.connection().execute(self.table(obj.__class__)['delete'],
+                                  (obj.id,))
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of cls
+        """
+        return self.connection().execute(
+            self.table(cls)['count']).fetchone()[0]
+
+    @contextmanager
+    def transaction(self):
+        """ Commit the writes of the current thread in the block at once;
+        nested blocks join the outer one
+        """
+        db = self.connection()
+        if self.local.depth == 0:
+            db.execute("BEGIN IMMEDIATE")
+        self.local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                db.execute("ROLLBACK")
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            db.execute("COMMIT")
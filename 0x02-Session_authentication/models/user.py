@@ -2,12 +2,14 @@
 """ User module
 """
 import hashlib
-from models.base import Base
+from models.base import Base, slots
 
 
 class User(Base):
     """ User class
     """
+    __slots__ = slots('email', '_password', 'first_name', 'last_name')
+    indexes = {'email': True}
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance